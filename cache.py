@@ -0,0 +1,115 @@
+import os
+import shutil
+import inspect
+import hashlib
+
+from matplotlib import rcParams
+
+import plotting
+from tex import mathtext_fast_path_enabled
+
+
+# Source code of item classes, by class
+_sources = {}
+
+
+def _class_source(cls):
+    if cls not in _sources:
+        try:
+            _sources[cls] = inspect.getsource(cls)
+        except (IOError, TypeError):
+            _sources[cls] = ''
+    return _sources[cls]
+
+
+def fingerprint(item, figsize, extra=()):
+    """
+    Returns a stable fingerprint of what an item draws.
+
+    The fingerprint covers the item class and its source code, the
+    item's as_string(), the figure size, DPI, LaTeX and mathtext
+    settings. 'extra' is a tuple of any other settings affecting the
+    image. dedup_key() is not used, as distinct items may share it.
+    """
+    cls = type(item)
+    source = _class_source(cls)
+
+    key = item.as_string()
+
+    if mathtext_fast_path_enabled():
+        extra += (('mathtext.fontset', rcParams['mathtext.fontset']),)
+
+    m = hashlib.sha1()
+    for value in (cls.__module__, cls.__name__, source, key, figsize,
+                  plotting.DPI, rcParams['text.usetex'],
+                  rcParams['text.latex.preamble'], extra):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = repr(value)
+        m.update(value)
+        m.update('\0')
+    return m.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link src to dst, or copy it if the file system can't link.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+class RenderCache(object):
+    """
+    Persistent cache of drawn images, keyed by their fingerprint.
+    Several builds may share a cache folder.
+    """
+    def __init__(self, folder):
+        self._folder = folder
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key, filepath):
+        ext = os.path.splitext(filepath)[1]
+        return os.path.join(self._folder, key[:2], key + ext)
+
+    def fetch(self, key, filepath):
+        """
+        Place the cached image for key at filepath.
+        Returns False if the image is not in the cache.
+        """
+        cached = self._path(key, filepath)
+        if not os.path.isfile(cached):
+            self.misses += 1
+            return False
+
+        link_or_copy(cached, filepath)
+        self.hits += 1
+        return True
+
+    def store(self, key, filepath):
+        """
+        Add the image at filepath to the cache as key.
+        """
+        cached = self._path(key, filepath)
+        if os.path.isfile(cached):
+            return
+
+        folder = os.path.dirname(cached)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Created by another build in the meantime
+                if not os.path.isdir(folder):
+                    raise
+
+        # Rename is atomic, so other builds never see half a file
+        tmp = '%s.%d.tmp' % (cached, os.getpid())
+        link_or_copy(filepath, tmp)
+        os.rename(tmp, cached)
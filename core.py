@@ -2,13 +2,24 @@
 # -*- coding: iso-8859-15 -*-
 # foer jul
 import os
+import re
 import sys
 import time
 import shutil
 import random
+import json
 import hashlib
+import tempfile
+import multiprocessing
 
-from html import make_html_preview
+from matplotlib import image
+
+import plotting
+from cache import RenderCache, fingerprint
+from optimize import Image, optimize_png
+from tex import record_latex, run_latex_batches, LATEX_BATCH_SIZE
+from question import SimilarityCache
+from html import HTMLPreview, make_html_index, THUMBNAIL_FOLDER, THUMBNAIL_WIDTH
 from quiz import QuizQuestionBase, QuizAnswerBase, QuizXMLReport
 from puzzle import PuzzleQuestionBase, PuzzleAnswerBase, PuzzleXMLReport
 
@@ -18,6 +29,25 @@ class FilenameList(list):
 
     def __init__(self, hashing=False):
         self._hashing = hashing
+        self._keyed = {}
+        self._unkeyed = []
+
+    def __contains__(self, elem):
+        """
+        Elements are looked up by their dedup_key(). Only elements with
+        the same key, or without a key, are compared using is_same_as().
+        """
+        key = elem.dedup_key()
+        if key is None:
+            return list.__contains__(self, elem)
+
+        for other in self._keyed.get(key, ()):
+            if other is elem or elem == other:
+                return True
+        for other in self._unkeyed:
+            if other is elem or elem == other:
+                return True
+        return False
 
     def _md5_filename(self, s):
         name, ext = os.path.splitext(s)
@@ -35,6 +65,12 @@ class FilenameList(list):
         list.append(self, elem)
         FilenameList.i += 1
 
+        key = elem.dedup_key()
+        if key is None:
+            self._unkeyed.append(elem)
+        else:
+            self._keyed.setdefault(key, []).append(elem)
+
     def _make_filename(self, i):
         raise NotImplementedError
 
@@ -49,6 +85,92 @@ class AnswerList(FilenameList):
         return 'a%04d.png' % i
 
 
+def _digest(string):
+    """
+    Returns a digest of a string returned by as_string(), which
+    may be unicode or a byte string in any encoding.
+    """
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    elif not isinstance(string, str):
+        string = repr(string)
+    return hashlib.sha1(string).hexdigest()
+
+
+# Draw jobs for worker processes. Assigned before the pool is created,
+# so forked workers inherit the items instead of receiving them pickled.
+_draw_jobs = []
+
+
+def _draw_job(i):
+    """
+    Draw job number i in a worker process.
+    """
+    item, filepath = _draw_jobs[i]
+    item.draw(filepath)
+    return i
+
+
+def _record_job(i):
+    """
+    Draw job number i to a temporary file in a worker process,
+    recording the LaTeX runs of its text (see tex.record_latex).
+    """
+    item, filepath = _draw_jobs[i]
+    fd, tmp = tempfile.mkstemp(suffix=os.path.splitext(filepath)[1])
+    os.close(fd)
+    try:
+        return record_latex(item.draw, tmp)
+    finally:
+        os.remove(tmp)
+
+
+def _latex_job(jobs):
+    """
+    Run LaTeX for a batch of strings in a worker process.
+    Returns the number of strings LaTeX ran for.
+    """
+    return run_latex_batches(jobs)
+
+
+def _scale_job(job):
+    """
+    Write a scaled copy of an image in a worker process.
+    The copy is written to a temporary file which replaces scaled_file
+    by a rename, as scaled_file may be a hard link into the render cache.
+    """
+    image_file, scaled_file, scale = job
+    name, ext = os.path.splitext(scaled_file)
+    tmp = '%s.%d.tmp%s' % (name, os.getpid(), ext)
+    try:
+        image.thumbnail(image_file, tmp, scale=scale)
+        os.rename(tmp, scaled_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _optimize_job(job):
+    """
+    Optimize a PNG image in a worker process.
+    Returns the number of bytes saved.
+    """
+    filepath, colors = job
+    return optimize_png(filepath, colors)
+
+
+class _ReportShard(object):
+    """
+    Reports and preview of the questions written to one set of files.
+    """
+    def __init__(self, name, group, report, preview):
+        self.name = name
+        self.group = group
+        self.report = report
+        self.preview = preview
+        self.questions = 0
+
+
 class _Generator(object):
     ERROR = 0
     IGNORE = 1
@@ -58,6 +180,26 @@ class _Generator(object):
 
     def __init__(self):
         self._debugging = False
+        self._workers = 1
+        self._render_cache = None
+        self._incremental = False
+        self._streaming = False
+        self._jsonl_export = False
+        self._merge = False
+        self._sharding = False
+        self._preview_page_size = None
+        self._png_colors = None
+        self._scales = [1]
+        self._latex_prepass = False
+        self._previous_images = set()
+        self._previous_digests = {}
+        self._previous_groups = {}
+        self._images = set()
+        self._digests = {}
+        self._group_files = {}
+        self._shards = {}
+        self._kept_shards = []
+        self._report_type = None
         self._duplicate_question = self.ERROR
         self._duplicate_answer = self.ERROR
         self._questions_sort = self.RANDOM
@@ -78,6 +220,128 @@ class _Generator(object):
     def enable_debugging(self):
         self._debugging = True
 
+    def set_workers(self, workers=None):
+        """
+        Draw images using a pool of 'workers' processes.
+        Defaults to the number of CPUs. 1 draws in this process.
+        Workers are forked, so they share the items to draw without
+        running the script again. Where processes can't be forked,
+        like on Windows, everything is drawn in this process.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if not isinstance(workers, int) or workers < 1:
+            raise RuntimeError('Number of workers must be a positive integer (got %s)' % str(workers))
+        if workers > 1 and not hasattr(os, 'fork'):
+            print 'Warning: processes can not be forked on this platform, so workers are not used'
+            workers = 1
+        self._workers = workers
+
+    def enable_render_cache(self, folder=None):
+        """
+        Reuse images drawn by earlier builds. Items are matched by
+        a fingerprint of their class, as_string(), figure size and
+        LaTeX settings, so draw() must depend on nothing else.
+        Defaults to ~/.sci2u/render_cache.
+        """
+        if folder is None:
+            folder = os.path.join(os.path.expanduser('~'), '.sci2u', 'render_cache')
+        self._render_cache = RenderCache(folder)
+
+    def enable_incremental(self):
+        """
+        Update the output folder from the previous build instead of
+        drawing everything again. Images are named by their fingerprint
+        (see enable_render_cache), so only new or changed items are
+        drawn, and images no longer in use are deleted.
+        """
+        self._incremental = True
+
+    def enable_merge(self):
+        """
+        Replace only the groups generated by this build in the output
+        folder. Questions and images of other groups are kept from the
+        previous build, which must have been made with enable_incremental()
+        or enable_merge(). Implies enable_incremental().
+        """
+        self._incremental = True
+        self._merge = True
+
+    def enable_streaming(self):
+        """
+        Process one group at a time: fetch, pick, draw and report
+        a group before moving on to the next, so memory use is bounded
+        by the largest group. Questions are sorted by difficulty
+        within each group only.
+        """
+        self._streaming = True
+
+    def enable_jsonl_export(self):
+        """
+        Also export combinations as JSON lines to combinations.jsonl,
+        which is faster to read than combinations.xml. The first line
+        holds the report settings and each following line a question.
+        See report.read_jsonl().
+        """
+        self._jsonl_export = True
+
+    def enable_sharding(self):
+        """
+        Split the output folder of very large banks. Images are placed
+        in 256 subfolders named by a hash of their filename, and each
+        group gets its own reports, combinations-<group>.xml (.jsonl,
+        .html). index.xml and index.html list the reports of all groups.
+        """
+        self._sharding = True
+
+    def enable_paginated_preview(self, questions_per_page=50):
+        """
+        Split the preview into pages of 'questions_per_page' questions
+        from the same group, which are listed in combinations.html.
+        Answers are shown by thumbnails, drawn to the thumbs folder.
+        """
+        if not isinstance(questions_per_page, int) or questions_per_page < 1:
+            raise RuntimeError('Number of questions per page must be a positive integer (got %s)' %
+                               str(questions_per_page))
+        self._preview_page_size = questions_per_page
+
+    def set_resolutions(self, *scales):
+        """
+        Also write images at 'scales' times the resolution of
+        plotting.DPI, e.g. set_resolutions(2) for HiDPI screens.
+        Images are drawn once at the highest resolution and scaled
+        down to the others. An image at scale 2 is named like
+        the image itself with @2x appended, and is listed in the
+        reports as filename_2x.
+        """
+        for scale in scales:
+            if not isinstance(scale, (int, float)) or scale <= 0:
+                raise RuntimeError('Resolution scale must be a positive number (got %s)' % str(scale))
+        self._scales = sorted(set(scales) | set([1]))
+
+    def enable_latex_prepass(self):
+        """
+        Before drawing, find the usetex text of all items to draw, by
+        drawing each with LaTeX left out, and run LaTeX for it in
+        batches of many strings per run (see tex.run_latex_batches),
+        using the pool of workers (see set_workers). Drawing then finds
+        the text in the LaTeX cache. With enable_streaming(), this is
+        done for each group.
+        """
+        self._latex_prepass = True
+
+    def enable_png_optimization(self, colors=256):
+        """
+        Quantize drawn PNG images to a palette of 'colors' colors and
+        recompress them, using the pool of workers (see set_workers).
+        Black text on white needs few colors. Requires Pillow.
+        """
+        if Image is None:
+            raise RuntimeError('PNG optimization requires Pillow (PIL)')
+        if not isinstance(colors, int) or not 2 <= colors <= 256:
+            raise RuntimeError('Number of colors must be an integer from 2 to 256 (got %s)' % str(colors))
+        self._png_colors = colors
+
 
     # -- How to handle duplicate questions -----------------------------------
 
@@ -109,118 +373,476 @@ class _Generator(object):
     # -- Processing ----------------------------------------------------------
 
     def generate_quiz(self, questions):
-        report = QuizXMLReport(self._questions_sort == self.RANDOM)
+        self._report_type = QuizXMLReport
         self._question_type = QuizQuestionBase
         self._answer_type = QuizAnswerBase
-        self._process(questions, report)
+        self._process(questions)
 
     def generate_puzzle(self, questions):
-        report = PuzzleXMLReport(self._questions_sort == self.RANDOM)
+        self._report_type = PuzzleXMLReport
         self._question_type = PuzzleQuestionBase
         self._answer_type = PuzzleAnswerBase
-        self._process(questions, report)
+        self._process(questions)
 
-    def _process(self, q, report):
+    def _process(self, q):
         print '----------------------------------------------------'
         print 'sci2u.dk generator API'
         print 'Mapping questions according to their group'
 
-        question_answer_pairs_final = []
-        all_questions = set()
-        all_answers = set()
-
-        for group, questions_raw in self._group_questions(q):
-            for extra_answer_group in self.extra_answers_dictionary.iterkeys():
-                if not extra_answer_group in self.all_groups:
-                    raise RuntimeError('Extra answer group "%s" not a valid question group' % extra_answer_group)
-            print '----------------------------------------------------'
-            print 'Processing %d questions in group "%s"' % (len(questions_raw), group)
-            print '----------------------------------------------------'
-            questions, answers = self._fetch(group, questions_raw)
-
-            print 'Group consists of %d questions and %d answers' % (len(questions), len(answers))
-            print '----------------------------------------------------'
-            print 'Picking answers to questions in group "%s"' % group
-            question_answer_pairs = []
-
-            # Pick answers for each question in group
-            for i, question in enumerate(questions):
-                print 'Picking answers for question %d of %d: %s' % (
-                    i+1, len(questions), str(question))
-                num_answers = question.num_answers_nomalized()
-                picked_answers = question.pick_answers(answers)
+        groups = self._group_questions(q)
+        for extra_answer_group in self.extra_answers_dictionary.iterkeys():
+            if not extra_answer_group in self.all_groups:
+                raise RuntimeError('Extra answer group "%s" not a valid question group' % extra_answer_group)
 
-                if len(picked_answers) < num_answers:
-                    raise RuntimeError('Too few answers were picked for question: %s (got %d, expected %d)' % (
-                        str(question), len(picked_answers), num_answers))
-                elif len(picked_answers) > num_answers:
-                    raise RuntimeError('Too many answers were picked for question: %s (got %d, expected %d)' % (
-                        str(question), len(picked_answers), num_answers))
-
-                # Make sure all picked answers are among all answers in group
-                for answer in picked_answers:
-                    if not answer in answers:
-                        raise RuntimeError('Question (%s) picked unknown answer: %s' % (
-                            str(question), str(answer)))
-
-                question.validate_answers(picked_answers)
-                question_answer_pairs.append((question, picked_answers))
-
-            print 'Group has %d questions which share %d answers' % (
-                len(questions),
-                len(answers),
-            )
+        self._shards = {}
+        try:
+            pairing = []
+
+            if self._streaming:
+                # Finish each group before the next one is fetched, so only
+                # one group of questions and answers is held at a time.
+                previous = self._prepare_folder()
+                self._open_reports()
+                if self._merge:
+                    self._merge_reports()
+
+                while groups:
+                    # Groups are dropped as they are done
+                    group, questions_raw = groups.pop(0)
+                    questions, answers, question_answer_pairs = self._pick_group(
+                        group, questions_raw)
+
+                    print '----------------------------------------------------'
+                    print 'Sorting questions in group "%s" by difficulty' % group
+                    question_answer_pairs.sort(key=lambda qa : qa[0])
+
+                    print 'Drawing images to %s' % self._folder
+                    self._draw_all(questions, answers)
+
+                    self._add_to_reports(question_answer_pairs)
+                    pairing.extend(self._pairing(question_answer_pairs))
+
+                    for question in questions:
+                        question._clear_caches()
+                    del questions_raw, questions, answers, question_answer_pairs
+            else:
+                question_answer_pairs_final = []
+                all_questions = set()
+                all_answers = set()
+
+                for group, questions_raw in groups:
+                    questions, answers, question_answer_pairs = self._pick_group(
+                        group, questions_raw)
+
+                    question_answer_pairs_final.extend(question_answer_pairs)
+                    all_questions.update(questions)
+                    all_answers.update(answers)
+
+                # Sort question-answer-pairs by Question (difficulty).
+                # Lowest difficulty is first in the list.
+                print '----------------------------------------------------'
+                print 'Sorting all questions by difficulty'
+                question_answer_pairs_final.sort(key=lambda qa : qa[0])
+
+                print '----------------------------------------------------'
+
+                previous = self._prepare_folder()
+                self._open_reports()
+                if self._merge:
+                    self._merge_reports()
+
+                # Draw questions and answers
+                print 'Drawing images to %s' % self._folder
+                self._draw_all(all_questions, all_answers)
+
+                self._add_to_reports(question_answer_pairs_final)
+                pairing.extend(self._pairing(question_answer_pairs_final))
+
+            if self._incremental:
+                signature = self._pairing_signature(pairing)
+                self._delete_unused_images()
+
+                if (not self._merge
+                    and signature == previous.get('pairing')
+                    and all(os.path.isfile(os.path.join(self._folder, filename))
+                            for filename in self._report_files())):
+                    print '----------------------------------------------------'
+                    print 'Combinations are unchanged'
+                    self._discard_reports()
+                else:
+                    self._write_reports()
+
+                self._save_manifest(signature)
+            else:
+                self._write_reports()
+        finally:
+            # Remove the temporary files of reports which were not saved
+            self._discard_reports()
 
-            question_answer_pairs_final.extend(question_answer_pairs)
-            all_questions.update(questions)
-            all_answers.update(answers)
+        print 'Done! Bye'
+        print '----------------------------------------------------'
 
-        # Sort question-answer-pairs by Question (difficulty).
-        # Lowest difficulty is first in the list.
+    def _pick_group(self, group, questions_raw):
+        """
+        Fetch questions and answers in a group and pick answers
+        for each question.
+        Returns (questions, answers, [(question, [answers]), ...])
+        """
+        print '----------------------------------------------------'
+        print 'Processing %d questions in group "%s"' % (len(questions_raw), group)
         print '----------------------------------------------------'
-        print 'Sorting all questions by difficulty'
-        question_answer_pairs_final.sort(key=lambda qa : qa[0])
+        questions, answers = self._fetch(group, questions_raw)
+        answers.similarities = SimilarityCache(answers)
+        for item in questions + answers:
+            item._group = group
 
+        print 'Group consists of %d questions and %d answers' % (len(questions), len(answers))
         print '----------------------------------------------------'
-        
-        # Delete directory and all of it's contents (if it exists)
-        if os.path.isdir(self._folder):
-            print 'Truncating directory: %s' % self._folder
-            shutil.rmtree(self._folder)
-        
-        # Create directory
-        os.makedirs(self._folder)
+        print 'Picking answers to questions in group "%s"' % group
+        question_answer_pairs = []
+
+        # Questions may pick answers for the whole group at once
+        group_picked_answers = None
+        if len(questions) > 0:
+            group_picked_answers = type(questions[0]).pick_group_answers(
+                questions, answers)
+
+        # Pick answers for each question in group
+        for i, question in enumerate(questions):
+            print 'Picking answers for question %d of %d: %s' % (
+                i+1, len(questions), str(question))
+            num_answers = question.num_answers_nomalized()
+            if group_picked_answers is not None:
+                picked_answers = group_picked_answers[i]
+            else:
+                picked_answers = question.pick_answers(answers)
+
+            if len(picked_answers) < num_answers:
+                raise RuntimeError('Too few answers were picked for question: %s (got %d, expected %d)' % (
+                    str(question), len(picked_answers), num_answers))
+            elif len(picked_answers) > num_answers:
+                raise RuntimeError('Too many answers were picked for question: %s (got %d, expected %d)' % (
+                    str(question), len(picked_answers), num_answers))
+
+            # Make sure all picked answers are among all answers in group
+            for answer in picked_answers:
+                if not answer in answers:
+                    raise RuntimeError('Question (%s) picked unknown answer: %s' % (
+                        str(question), str(answer)))
+
+            question.validate_answers(picked_answers)
+            question.validate_layout()
+            question_answer_pairs.append((question, picked_answers))
+
+        print 'Group has %d questions which share %d answers' % (
+            len(questions),
+            len(answers),
+        )
+
+        return questions, answers, question_answer_pairs
+
+    def _prepare_folder(self):
+        """
+        Create an empty output folder, or keep the existing folder
+        when building incrementally on top of a previous build.
+        Returns the manifest of the previous build.
+        """
+        previous = {}
+        if self._incremental:
+            previous = self._load_manifest()
+
+        if previous and 'groups' not in previous:
+            # Written before groups were recorded, so nothing can be kept
+            print 'Warning: manifest.json does not list the groups of the previous build'
+            previous = {}
+
+        if previous and previous.get('sharded', False) != self._sharding:
+            if self._merge:
+                raise RuntimeError('Can not merge into %s, as it was built %s sharding' % (
+                    self._folder, 'with' if previous.get('sharded') else 'without'))
+            # Start over, as no file name is the same
+            previous = {}
+
+        self._previous_images = set(previous.get('images', []))
+        self._previous_digests = previous.get('digests', {})
+        # Group names are read as written by _save_manifest()
+        self._previous_groups = dict((group.encode('latin-1'), files)
+                                     for group, files in previous.get('groups', {}).iteritems())
+        self._images = set()
+        self._digests = {}
+        self._group_files = {}
+
+        if (self._merge and not previous
+            and (os.path.isfile(os.path.join(self._folder, 'combinations.xml'))
+                 or os.path.isfile(os.path.join(self._folder, 'index.xml')))):
+            raise RuntimeError('Can not merge into %s, as it has no manifest.json listing the groups of a previous build' %
+                               self._folder)
+
+        if previous:
+            print 'Updating directory: %s' % self._folder
+        else:
+            # Delete directory and all of it's contents (if it exists)
+            if os.path.isdir(self._folder):
+                print 'Truncating directory: %s' % self._folder
+                shutil.rmtree(self._folder)
+
+            # Create directory
+            os.makedirs(self._folder)
 
         # Include .py file in directory
         shutil.copy(self._filename, self._folder)
-        
-        # Draw questions and answers
-        print 'Drawing images to %s' % self._folder
-        self._draw(all_questions, 'question')
-        self._draw(all_answers, 'answer')
 
-        # Write reports
-        print '----------------------------------------------------'
-        print 'Writing combination files to %s' % self._folder
-        print 'Writing export file: combinations.xml'
-        for question, answers in question_answer_pairs_final:
-            report.add_question(question, answers)
-        report.save(os.path.join(self._folder, 'combinations.xml'))
-
-        print 'Writing preview file: combinations.html'
-        # Sorts answers randomly for preview.
-        question_answer_pairs_final_preview = list(question_answer_pairs_final)
-        for question, answers in question_answer_pairs_final_preview:
+        return previous
+
+    def _load_manifest(self):
+        """
+        Returns the manifest of the build in the output folder,
+        or an empty dictionary if there is none.
+        """
+        try:
+            with open(os.path.join(self._folder, 'manifest.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_manifest(self, pairing):
+        groups = dict(
+            (group, {
+                'questions': sorted(files['questions']),
+                'images': sorted(files['images']),
+            })
+            for group, files in self._group_files.iteritems())
+        manifest = {
+            'images': sorted(self._images),
+            'digests': self._digests,
+            'groups': groups,
+            'pairing': pairing,
+            'sharded': self._sharding,
+        }
+        # Group names are byte strings in any encoding, which
+        # latin-1 maps to unicode and back as they are
+        with open(os.path.join(self._folder, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1, encoding='latin-1')
+
+    def _merge_reports(self):
+        """
+        Add the questions of groups which are not generated by this build
+        from the previous reports, and keep their images.
+        When sharding, the reports of those groups are kept as they are.
+        """
+        keep = {}
+        for group, files in self._previous_groups.iteritems():
+            if group in self.all_groups:
+                continue
+            self._group_files[group] = {
+                'questions': set(files['questions']),
+                'images': set(files['images']),
+            }
+            self._images.update(files['images'])
+            self._digests.update((filename, self._previous_digests[filename])
+                                 for filename in files['images']
+                                 if filename in self._previous_digests)
+            keep.update((filename, group) for filename in files['questions'])
+            if self._sharding:
+                self._kept_shards.append(
+                    (group, self._shard_name(group), len(files['questions'])))
+
+        print 'Keeping %d questions from %d other groups' % (
+            len(keep), len(self._group_files))
+
+        if self._sharding:
+            for group, name, count in self._kept_shards:
+                if not os.path.isfile(os.path.join(self._folder, name + '.xml')):
+                    print 'Warning: %s.xml of group "%s" is missing' % (name, group)
+            return
+
+        shard = self._shards['combinations']
+        xml_file = os.path.join(self._folder, 'combinations.xml')
+        if os.path.isfile(xml_file):
+            # Kept questions are shown in the preview as well
+            shard.report.merge(
+                xml_file, lambda filename: filename in keep,
+                lambda element: shard.preview.add_element(
+                    element, keep[element.getAttribute('filename')]))
+
+        if self._jsonl_export:
+            jsonl_file = os.path.join(self._folder, 'combinations.jsonl')
+            if os.path.isfile(jsonl_file):
+                shard.report.merge_jsonl(jsonl_file, lambda filename: filename in keep)
+            elif keep:
+                print 'Warning: kept questions are missing from combinations.jsonl'
+
+    def _delete_unused_images(self):
+        """
+        Delete images from the previous build which are no longer in use.
+        """
+        unused = self._previous_images - self._images
+        for filename in unused:
+            for filepath in (os.path.join(self._folder, filename),
+                             os.path.join(self._folder, THUMBNAIL_FOLDER, filename)):
+                if os.path.isfile(filepath):
+                    os.remove(filepath)
+        print 'Deleted %d unused images' % len(unused)
+
+    def _pairing(self, question_answer_pairs):
+        """
+        Returns which answers are paired with which questions, by filename.
+        """
+        return [(question._filename, sorted(answer._filename for answer in answers))
+                for question, answers in question_answer_pairs]
+
+    def _pairing_signature(self, pairing):
+        """
+        Returns a digest of which answers are paired with which questions,
+        and of the settings of the reports and previews. As images are
+        named by their fingerprint, it does not change unless the
+        reports would.
+        """
+        m = hashlib.sha1()
+        m.update(repr((self._report_type.__name__, self._questions_sort, sorted(pairing),
+                       self._scales, self._preview_page_size, self._jsonl_export)))
+        return m.hexdigest()
+
+    def _shard_name(self, group):
+        """
+        Returns the name of the reports of a group, which is
+        combinations-<group> with any unsafe characters replaced.
+        """
+        name = re.sub(r'[^A-Za-z0-9_-]', '_', group)
+        if name != group or not name:
+            # Different groups may have the same safe name
+            name = '%s-%s' % (name, hashlib.md5(group).hexdigest()[:8])
+        return 'combinations-%s' % name
+
+    def _shard_path(self, filename):
+        """
+        Returns the path of an image within the output folder,
+        in a subfolder named by a hash of its filename when sharding.
+        """
+        filename = os.path.basename(filename)
+        if not self._sharding:
+            return filename
+        return os.path.join(hashlib.md5(filename).hexdigest()[:2], filename)
+
+    def _add_to_reports(self, question_answer_pairs):
+        if self._sharding:
+            # Add one group at a time, finishing the reports of each
+            # group before the next, so few files are open at once.
+            # Questions keep their order within each group.
+            question_answer_pairs = sorted(question_answer_pairs,
+                                           key=lambda qa: qa[0]._group)
+
+        shard = None
+        for question, answers in question_answer_pairs:
+            if self._sharding:
+                name = self._shard_name(question._group)
+                if shard is not None and shard.name != name:
+                    shard.report.finish()
+                shard = self._open_shard(name, question._group)
+            else:
+                shard = self._shards['combinations']
+
+            shard.report.add_question(question, answers)
+            shard.questions += 1
+
+            # Sorts answers randomly for preview.
+            answers = list(answers)
             if question.sort_answers_randomly:
                 random.shuffle(answers)
+            shard.preview.add_question(question, answers)
+
+        if self._sharding and shard is not None:
+            shard.report.finish()
+
+    def _report_files(self):
+        files = []
+        for name in self._shards:
+            files.extend([name + '.xml', name + '.html'])
+            if self._jsonl_export:
+                files.append(name + '.jsonl')
+        if self._sharding:
+            files.extend(['index.xml', 'index.html'])
+        return files
+
+    def _open_reports(self):
+        """
+        Stream reports to temporary files until they are saved.
+        When sharding, the reports of each group are opened as
+        its first question is added.
+        """
+        self._shards = {}
+        self._kept_shards = []
+        if not self._sharding:
+            self._open_shard('combinations')
+
+    def _open_shard(self, name, group=None):
+        if name not in self._shards:
+            shard = _ReportShard(
+                name, group, self._report_type(self._questions_sort == self.RANDOM),
+                HTMLPreview(self._preview_page_size,
+                            thumbnails=self._preview_page_size is not None))
+            shard.report.open(os.path.join(self._folder, name + '.xml.part'))
+            if self._jsonl_export:
+                shard.report.open_jsonl(os.path.join(self._folder, name + '.jsonl.part'))
+            self._shards[name] = shard
+        return self._shards[name]
+
+    def _discard_reports(self):
+        for shard in self._shards.itervalues():
+            shard.report.discard()
+
+    def _write_reports(self):
+        """
+        Write combinations.xml and combinations.html, or the reports
+        of each group and their index when sharding.
+        """
+        print '----------------------------------------------------'
+        print 'Writing combination files to %s' % self._folder
+        for name, shard in sorted(self._shards.iteritems()):
+            print 'Writing export file: %s.xml' % name
+            shard.report.save(os.path.join(self._folder, name + '.xml'))
+            if self._jsonl_export:
+                print 'Writing export file: %s.jsonl' % name
+                shard.report.save_jsonl(os.path.join(self._folder, name + '.jsonl'))
 
-        make_html_preview(
-            question_answer_pairs_final_preview,
-            os.path.join(self._folder, 'combinations.html'),
-        )
+            print 'Writing preview file: %s.html' % name
+            shard.preview.save(os.path.join(self._folder, name + '.html'))
 
-        print 'Done! Bye'
-        print '----------------------------------------------------'
+        if self._sharding:
+            self._write_index()
+
+    def _write_index(self):
+        """
+        Write index.xml and index.html, which list the reports of
+        all groups, and delete reports of groups which are gone.
+        """
+        shards = [(shard.group, name, shard.questions)
+                  for name, shard in self._shards.iteritems()]
+        shards = sorted(shards + self._kept_shards)
+
+        extensions = ['.xml', '.html']
+        if self._jsonl_export:
+            extensions.append('.jsonl')
+
+        print 'Writing index file: index.xml'
+        index = self._report_type(self._questions_sort == self.RANDOM)
+        index.save_index(os.path.join(self._folder, 'index.xml'),
+                         [(group, [name + ext for ext in extensions], count)
+                          for group, name, count in shards])
+
+        print 'Writing preview file: index.html'
+        make_html_index([(group, name + '.html', count) for group, name, count in shards],
+                        os.path.join(self._folder, 'index.html'))
+
+        names = set(name for group, name, count in shards)
+        for group in self._previous_groups:
+            name = self._shard_name(group)
+            if name in names:
+                continue
+            for ext in ('.xml', '.html', '.jsonl'):
+                filepath = os.path.join(self._folder, name + ext)
+                if os.path.isfile(filepath):
+                    os.remove(filepath)
 
     def _group_questions(self, questions):
         """
@@ -365,22 +987,330 @@ class _Generator(object):
 
         self.extra_answers_dictionary = answer_dict        
 
-    def _draw(self, items, type_name):
+    def _draw_all(self, questions, answers):
+        """
+        Draw the questions and answers, after running LaTeX for
+        the text of both if enabled (see enable_latex_prepass).
+        """
+        plans = [self._plan_draw(questions, 'question'),
+                 self._plan_draw(answers, 'answer')]
+        if self._latex_prepass:
+            self._run_latex([job for plan in plans for job in plan[2]])
+        for plan in plans:
+            self._draw(*plan)
+
+    def _plan_draw(self, items, type_name):
         """
-        Invoke draw on all items in the list 'items'.
+        Name the images of all items in the list 'items', and find
+        those which must be drawn.
         'type_name' is a string identifying what type 
             of item it is (question/answer).
+        Returns (type_name, figsize, jobs, filepaths, kept, cached)
+        for _draw().
         """
-        for i, item in enumerate(items):
-            print 'Drawing %s %d of %d: %s => %s' % (
-                type_name, i+1, len(items), str(item), item._filename)
+        if type_name == 'question':
+            figsize = plotting.QUESTION_FIGSIZE
+        else:
+            figsize = plotting.ANSWER_FIGSIZE
+
+        jobs = []
+        filepaths = set()
+        cached = 0
+        kept = 0
+        for item in items:
+            if self._render_cache is not None or self._incremental:
+                item._fingerprint = fingerprint(item, figsize, self._fingerprint_extra())
+
+            if self._incremental:
+                ext = os.path.splitext(item._filename)[1]
+                item._filename = item._fingerprint + ext
+            item._filename = self._shard_path(item._filename)
+            item._variants = [(scale, self._variant_filename(item._filename, scale))
+                              for scale in self._scales if scale != 1]
+            image_files = self._image_files(item)
+
+            if self._incremental:
+                digest = _digest(item.as_string())
+                for scale, filename in image_files:
+                    if self._digests.setdefault(filename, digest) != digest:
+                        raise RuntimeError('Image %s is drawn for items with different as_string(), one of them %s' % (
+                            filename, str(item)))
+                self._images.update(filename for scale, filename in image_files)
+
+                files = self._group_files.setdefault(
+                    item._group, {'questions': set(), 'images': set()})
+                files['images'].update(filename for scale, filename in image_files)
+                if type_name == 'question':
+                    files['questions'].add(item._filename)
+
             filepath = os.path.join(self._folder, item._filename)
+
+            # Items with the same fingerprint share an image
+            if filepath in filepaths:
+                continue
+            filepaths.add(filepath)
+
+            folder = os.path.dirname(filepath)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+            # Images from the previous build are kept
+            if all(filename in self._previous_images
+                   and self._is_previous_image(filename, digest, item)
+                   and os.path.isfile(os.path.join(self._folder, filename))
+                   for scale, filename in image_files):
+                kept += 1
+                continue
+
+            # Images in the render cache are not drawn again
+            if self._render_cache is not None:
+                if all(self._render_cache.fetch(self._cache_key(item, scale),
+                                                os.path.join(self._folder, filename))
+                       for scale, filename in image_files):
+                    cached += 1
+                    continue
+
+            # Images are drawn at the highest resolution
+            jobs.append((item, os.path.join(self._folder, image_files[-1][1])))
+
+        return type_name, figsize, jobs, filepaths, kept, cached
+
+    def _draw(self, type_name, figsize, jobs, filepaths, kept, cached):
+        """
+        Invoke draw for the jobs planned by _plan_draw().
+        """
+        top = self._scales[-1]
+        dpi = plotting.DPI
+        plotting.DPI, plotting.SCALE = dpi * top, top
+        try:
+            parallel = self._workers > 1 and len(jobs) > 1
+            if parallel:
+                done = self._draw_parallel(jobs)
+            else:
+                done = self._draw_serial(jobs, type_name)
+
+            for i, j in enumerate(done):
+                item, filepath = jobs[j]
+                if parallel:
+                    # Items are reported as workers finish them
+                    print 'Drew %s %d of %d: %s => %s' % (
+                        type_name, i+1, len(jobs), str(item), item._filename)
+
+                if not self._debugging and not os.path.isfile(filepath):
+                    raise RuntimeError('No image was drawn: %s' % filepath)
+        finally:
+            plotting.DPI, plotting.SCALE = dpi, 1
+
+        if len(self._scales) > 1:
+            self._scale_down(jobs, type_name)
+
+        if self._png_colors is not None:
+            self._optimize(jobs, type_name)
+
+        if self._render_cache is not None:
+            for item, filepath in jobs:
+                for scale, filename in self._image_files(item):
+                    filepath = os.path.join(self._folder, filename)
+                    if os.path.isfile(filepath):
+                        self._render_cache.store(self._cache_key(item, scale), filepath)
+
+        if type_name == 'answer' and self._preview_page_size is not None:
+            self._make_thumbnails(filepaths, figsize)
+
+        if self._incremental:
+            print '%d %ss were kept from the previous build' % (kept, type_name)
+        if self._render_cache is not None:
+            print '%d %ss were taken from the render cache' % (cached, type_name)
+        print 'Drawing of %d %ss complete' % (len(jobs), type_name)
+
+    def _is_previous_image(self, filename, digest, item):
+        """
+        Returns True if the previous build drew the image for an item
+        with the same as_string(), by the digest of as_string().
+        Images of manifests without digests are not reused.
+        """
+        previous = self._previous_digests.get(filename)
+        if previous is None:
+            return False
+        if previous != digest:
+            raise RuntimeError('Image %s was drawn for another item than %s by the previous build' % (
+                filename, str(item)))
+        return True
+
+    def _fingerprint_extra(self):
+        """
+        Returns the settings, other than those of plotting, which
+        affect drawn images.
+        """
+        extra = ()
+        if self._png_colors is not None:
+            extra += (('png_colors', self._png_colors),)
+        if len(self._scales) > 1:
+            extra += (('scales', tuple(self._scales)),)
+        return extra
+
+    def _variant_filename(self, filename, scale):
+        """
+        Returns the filename of an image at another resolution,
+        e.g. a.png is a@2x.png at twice the resolution.
+        """
+        name, ext = os.path.splitext(filename)
+        return '%s@%gx%s' % (name, scale, ext)
+
+    def _image_files(self, item):
+        """
+        Returns [(scale, filename), ...] of an item's images,
+        from the lowest to the highest resolution.
+        """
+        return [(1, item._filename)] + item._variants
+
+    def _cache_key(self, item, scale):
+        if scale == 1:
+            return item._fingerprint
+        return '%s@%gx' % (item._fingerprint, scale)
+
+    def _run_latex(self, jobs):
+        """
+        Run LaTeX for the usetex text of the items drawn by jobs,
+        recorded by drawing them at the resolution they are drawn at.
+        """
+        if not jobs:
+            return
+
+        global _draw_jobs
+        _draw_jobs = jobs
+        top = self._scales[-1]
+        dpi = plotting.DPI
+        plotting.DPI, plotting.SCALE = dpi * top, top
+        try:
+            latex_jobs = set()
+            for recorded in self._map(_record_job, range(len(jobs))):
+                latex_jobs.update(recorded)
+        finally:
+            plotting.DPI, plotting.SCALE = dpi, 1
+            _draw_jobs = []
+        if not latex_jobs:
+            return
+
+        # The jobs of a string, at each dpi, are kept in one batch
+        strings = {}
+        for tex, fontsize, dpi in latex_jobs:
+            strings.setdefault((tex, fontsize), []).append((tex, fontsize, dpi))
+        strings = [strings[key] for key in sorted(strings)]
+
+        # Split into a batch for each worker, if that makes them smaller
+        size = min(LATEX_BATCH_SIZE, -(-len(strings) // self._workers))
+        batches = [sum(strings[i:i + size], []) for i in xrange(0, len(strings), size)]
+        runs = sum(self._map(_latex_job, batches))
+        print 'Ran LaTeX in batches for %d of %d strings' % (runs, len(strings))
+
+    def _scale_down(self, jobs, type_name):
+        """
+        Write the images drawn by jobs at the lower resolutions.
+        """
+        top = self._scales[-1]
+        scale_jobs = []
+        for item, filepath in jobs:
+            if not os.path.isfile(filepath):
+                continue
+            for scale, filename in self._image_files(item)[:-1]:
+                scale_jobs.append((filepath, os.path.join(self._folder, filename),
+                                   float(scale) / top))
+
+        for _ in self._map(_scale_job, scale_jobs):
+            pass
+        print 'Scaled %d %ss to %d resolutions' % (len(jobs), type_name, len(self._scales) - 1)
+
+    def _optimize(self, jobs, type_name):
+        """
+        Optimize the PNG images of jobs, in all resolutions.
+        """
+        optimize_jobs = []
+        for item, filepath in jobs:
+            for scale, filename in self._image_files(item):
+                filepath = os.path.join(self._folder, filename)
+                if filepath.lower().endswith('.png') and os.path.isfile(filepath):
+                    optimize_jobs.append((filepath, self._png_colors))
+
+        size = sum(os.path.getsize(filepath) for filepath, colors in optimize_jobs)
+        saved = sum(self._map(_optimize_job, optimize_jobs))
+
+        print 'Optimized %d %s images, saving %d of %d bytes (%.0f%%)' % (
+            len(optimize_jobs), type_name, saved, size,
+            100. * saved / size if size else 0.)
+
+    def _draw_serial(self, jobs, type_name):
+        """
+        Draw jobs one at a time in this process.
+        Yields the index of each job as it is drawn.
+        """
+        for i, (item, filepath) in enumerate(jobs):
+            print 'Drawing %s %d of %d: %s => %s' % (
+                type_name, i+1, len(jobs), str(item), item._filename)
             item.draw(filepath)
+            yield i
 
-            if not self._debugging and not os.path.isfile(filepath):
-                raise RuntimeError('No image was drawn: %s' % filepath)
+    def _draw_parallel(self, jobs):
+        """
+        Draw jobs in a pool of worker processes.
+        Yields the index of each job as it is drawn.
+        """
+        global _draw_jobs
+        _draw_jobs = jobs
+        try:
+            for i in self._map(_draw_job, range(len(jobs))):
+                yield i
+        finally:
+            _draw_jobs = []
+
+    def _map(self, function, jobs):
+        """
+        Call a module level function with each job, in a pool of
+        worker processes if there are several workers.
+        Yields the results as they are done.
+        """
+        if self._workers == 1 or len(jobs) < 2:
+            for job in jobs:
+                yield function(job)
+            return
 
-        print 'Drawing of %d %ss complete' % (len(items), type_name)
+        pool = multiprocessing.Pool(min(self._workers, len(jobs)))
+        try:
+            for result in pool.imap_unordered(function, jobs):
+                yield result
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def _make_thumbnails(self, filepaths, figsize):
+        """
+        Make thumbnails of the images which have none, or
+        an outdated one, for the preview.
+        """
+        scale = float(THUMBNAIL_WIDTH) / (figsize[0] * plotting.DPI)
+        jobs = []
+        for filepath in sorted(filepaths):
+            if not os.path.isfile(filepath):
+                continue
+
+            filename = os.path.relpath(filepath, self._folder)
+            thumb_file = os.path.join(self._folder, THUMBNAIL_FOLDER, filename)
+            if (os.path.isfile(thumb_file)
+                and os.path.getmtime(thumb_file) >= os.path.getmtime(filepath)):
+                continue
+
+            folder = os.path.dirname(thumb_file)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            jobs.append((filepath, thumb_file, scale))
+
+        for _ in self._map(_scale_job, jobs):
+            pass
+        print 'Made %d thumbnails' % len(jobs)
 
     # Legacy
     disallow_dublicate_questions = disallow_duplicate_questions
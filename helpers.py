@@ -1,13 +1,56 @@
 from sympy import Matrix, latex as sympy_latex
 from re import findall
+from collections import OrderedDict, namedtuple
+
+# Number of expressions whose latex is remembered by latex()
+LATEX_CACHE_SIZE = 10000
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_latex_cache = OrderedDict()
+_latex_cache_hits = 0
+_latex_cache_misses = 0
+
+# Containers which compare equal while holding elements of different
+# types, like (1, 2) and (1.0, 2), which print differently
+_CONTAINER_TYPES = (tuple, list, set, frozenset, dict)
 
 def latex(expr, big=False, **kwargs):
     """
     Returns a customized latex version of a sympy expression.
+    The latex of the last LATEX_CACHE_SIZE expressions is remembered,
+    see latex_cache_info(), except for tuples, lists, sets and
+    dictionaries.
     """
+    global _latex_cache_hits, _latex_cache_misses
+
     if type(expr)==type(Matrix()):
         raise TypeError("Matrices MUST be given to latex_matrix()")
 
+    if (isinstance(expr, _CONTAINER_TYPES)
+        or any(isinstance(value, _CONTAINER_TYPES) for value in kwargs.itervalues())):
+        return _latex(expr, big, **kwargs)
+
+    # Equal numbers of different types, like 2 and 2.0, print differently
+    key = (type(expr), expr, big, tuple(sorted(kwargs.items())))
+    try:
+        return_string = _latex_cache.pop(key)
+    except TypeError:
+        # Unhashable expression or argument
+        return _latex(expr, big, **kwargs)
+    except KeyError:
+        _latex_cache_misses += 1
+        return_string = _latex(expr, big, **kwargs)
+    else:
+        _latex_cache_hits += 1
+
+    # Most recently used last
+    _latex_cache[key] = return_string
+    while len(_latex_cache) > LATEX_CACHE_SIZE:
+        _latex_cache.popitem(last=False)
+    return return_string
+
+def _latex(expr, big=False, **kwargs):
     return_string = sympy_latex(expr, **kwargs)
 
     if big:
@@ -15,6 +58,23 @@ def latex(expr, big=False, **kwargs):
 
     return return_string.replace(r'\log', r'\ln')
 
+def latex_cache_info():
+    """
+    Returns the hits, misses, maximum and current size of
+    the cache of latex().
+    """
+    return CacheInfo(_latex_cache_hits, _latex_cache_misses,
+                     LATEX_CACHE_SIZE, len(_latex_cache))
+
+def latex_cache_clear():
+    """
+    Empties the cache of latex() and resets its counters.
+    """
+    global _latex_cache_hits, _latex_cache_misses
+    _latex_cache.clear()
+    _latex_cache_hits = 0
+    _latex_cache_misses = 0
+
 def latex_matrix(expr, parenthesis='(', equation_system=False, equation_dist=2, plus_dist = 5, minus_dist = 2, accomodate_fractions=True):
     """
     Returns a customized latex version of a sympy matrix.
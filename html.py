@@ -1,3 +1,6 @@
+import os
+import cgi
+
 
 TOP_TEMPLATE = '''
 <html>
@@ -22,7 +25,7 @@ div.answers { float: right; max-width: 350px; }
 
 QUESTION_TEMPLATE = '''
 <div>
-    <img class="question" src="%s" />
+    <img class="question" src="%s"%s loading="lazy" />
     <div class="answers">
         %s
     </div>
@@ -33,31 +36,243 @@ QUESTION_TEMPLATE = '''
 
 
 ANSWER_TEMPLATE = '''
-<img src="%s" class="answer %s" />
+<img src="%s"%s class="answer %s" loading="lazy" />
 '''
 
 
-def make_html_preview(question_answer_pairs, filepath):
-    questions_html_parts = []
+THUMBNAIL_TEMPLATE = '''
+<a href="%s"><img src="%s" class="answer %s" loading="lazy" /></a>
+'''
+
+
+NAVIGATION_TEMPLATE = '''
+<p>
+    <b>%s, page %d of %d</b> |
+    <a href="%s">Contents</a> |
+    %s |
+    %s
+</p>
+'''
+
+
+CONTENTS_TEMPLATE = '''
+<h2>%s</h2>
+<p>%s</p>
+'''
+
+
+# Folder of answer thumbnails, relative to the preview
+THUMBNAIL_FOLDER = 'thumbs'
+THUMBNAIL_WIDTH = 150
+
+
+def _srcset(filename, variants):
+    """
+    Returns a srcset attribute listing an image in other
+    resolutions, given as [(scale, filename), ...], if there are any.
+    """
+    if not variants:
+        return ''
+    sources = ['%s 1x' % filename]
+    sources.extend('%s %gx' % (filename, scale) for scale, filename in variants)
+    return ' srcset="%s"' % ', '.join(sources)
+
+
+def _element_variants(element):
+    """
+    Returns [(scale, filename), ...] of an image in other resolutions,
+    from the filename_<scale>x attributes of a report element.
+    """
+    variants = []
+    for name, value in element.attributes.items():
+        if name.startswith('filename_') and name.endswith('x'):
+            variants.append((float(name[len('filename_'):-1]), value))
+    return sorted(variants)
+
+
+def _link(href, text):
+    if href is None:
+        return text
+    return '<a href="%s">%s</a>' % (href, text)
+
+
+class HTMLPreview(object):
+    """
+    Preview of questions and their answers, added one at a time.
+
+    If questions_per_page is given, the questions of each group are
+    split into pages of that many questions, which are listed on the
+    page saved by save(). If thumbnails is True, answers are shown
+    by their thumbnail in THUMBNAIL_FOLDER.
+    """
+    def __init__(self, questions_per_page=None, thumbnails=False):
+        self._questions_per_page = questions_per_page
+        self._thumbnails = thumbnails
+        self._questions_html_parts = []
+        self._groups = {}
+
+    def add_question(self, question, answers):
+        self._add(getattr(question, '_group', ''),
+                  question._filename, getattr(question, '_variants', ()),
+                  [(answer._filename, getattr(answer, '_variants', ()),
+                    question._is_correct(answer))
+                   for answer in answers])
     
-    for question, answers in question_answer_pairs:
+    def add_element(self, question, group=''):
+        """
+        Add a question element of an XML report, like the questions
+        kept from a previous build.
+        """
+        # Answers of puzzles are correct if placed on a tile
+        tile_answers = set(tile.getAttribute('answer')
+                           for tile in question.getElementsByTagName('tile'))
+        answers = []
+        for answer in question.getElementsByTagName('answer'):
+            filename = answer.getAttribute('filename')
+            is_correct = (answer.getAttribute('is_correct') == '1'
+                          or filename in tile_answers)
+            answers.append((filename, _element_variants(answer), is_correct))
+        
+        self._add(group, question.getAttribute('filename'),
+                  _element_variants(question), answers)
+    
+    def _add(self, group, filename, variants, answers):
+        """
+        Add a question by its image, with answers given as
+        [(filename, variants, is correct), ...].
+        """
         answers_html_parts = []
         
-        for answer in answers:
-            if question.is_correct_answer(answer):
+        for answer_filename, answer_variants, is_correct in answers:
+            if is_correct:
                 cls = 'correct'
             else:
                 cls = ''
             
-            answers_html_parts.append(ANSWER_TEMPLATE % (answer._filename, cls))
+            if self._thumbnails:
+                thumb = '/'.join([THUMBNAIL_FOLDER, answer_filename])
+                answers_html_parts.append(THUMBNAIL_TEMPLATE % (answer_filename, thumb, cls))
+            else:
+                answers_html_parts.append(ANSWER_TEMPLATE % (
+                    answer_filename, _srcset(answer_filename, answer_variants), cls))
         
         answers_html = ''.join(answers_html_parts)
-        question_html = QUESTION_TEMPLATE % (question._filename, answers_html)
-        questions_html_parts.append(question_html)
+        question_html = QUESTION_TEMPLATE % (
+            filename, _srcset(filename, variants), answers_html)
+        if self._questions_per_page is None:
+            self._questions_html_parts.append(question_html)
+        else:
+            self._groups.setdefault(group, []).append(question_html)
+
+    def save(self, filepath):
+        if self._questions_per_page is not None:
+            self._save_pages(filepath)
+            return
+        
+        questions_html = ''.join(self._questions_html_parts)
+        html = TOP_TEMPLATE % questions_html
+        
+        with open(filepath, 'w') as htmlfile:
+            htmlfile.write(html)
+        
+        _delete_pages(filepath, 0)
+
+    def _save_pages(self, filepath):
+        """
+        Write the pages next to filepath, as <name>.1.html and so on,
+        and a list of them to filepath.
+        """
+        folder, filename = os.path.split(filepath)
+        name = os.path.splitext(filename)[0]
+        
+        # [(group, page in group, pages in group, questions_html_parts), ...]
+        pages = []
+        for group in sorted(self._groups):
+            parts = self._groups[group]
+            count = (len(parts) + self._questions_per_page - 1) // self._questions_per_page
+            for i in xrange(count):
+                start = i * self._questions_per_page
+                pages.append((group, i + 1, count,
+                              parts[start:start + self._questions_per_page]))
+        
+        page_filenames = ['%s.%d.html' % (name, i + 1) for i in xrange(len(pages))]
+        contents_parts = {}
+        
+        for i, (group, number, count, parts) in enumerate(pages):
+            previous_page = page_filenames[i - 1] if i > 0 else None
+            next_page = page_filenames[i + 1] if i + 1 < len(pages) else None
+            navigation = NAVIGATION_TEMPLATE % (
+                cgi.escape(group), number, count, filename,
+                _link(previous_page, 'Previous'), _link(next_page, 'Next'))
+            html = TOP_TEMPLATE % (navigation + ''.join(parts) + navigation)
+            
+            with open(os.path.join(folder, page_filenames[i]), 'w') as htmlfile:
+                htmlfile.write(html)
+            
+            contents_parts.setdefault(group, []).append(
+                _link(page_filenames[i], str(number)))
+        
+        contents_html = ''.join(
+            CONTENTS_TEMPLATE % (cgi.escape(group), ' '.join(contents_parts[group]))
+            for group in sorted(contents_parts))
+        
+        with open(filepath, 'w') as htmlfile:
+            htmlfile.write(TOP_TEMPLATE % contents_html)
+        
+        _delete_pages(filepath, len(pages))
+
+
+def _delete_pages(filepath, pages):
+    """
+    Delete the pages next to filepath after the first 'pages' pages,
+    left by an earlier preview with more pages.
+    """
+    name = os.path.splitext(filepath)[0]
+    i = pages + 1
+    while os.path.isfile('%s.%d.html' % (name, i)):
+        os.remove('%s.%d.html' % (name, i))
+        i += 1
+
+
+def make_html_preview(question_answer_pairs, filepath):
+    preview = HTMLPreview()
     
-    questions_html = ''.join(questions_html_parts)
-    html = TOP_TEMPLATE % questions_html
+    for question, answers in question_answer_pairs:
+        preview.add_question(question, answers)
     
-    with open(filepath, 'w') as htmlfile:
-        htmlfile.write(html)
+    preview.save(filepath)
+
 
+
+INDEX_TEMPLATE = '''
+<html>
+<head>
+<title>Preview!</title>
+</head>
+<body>
+
+<h1>Preview</h1>
+
+<ul>
+%s
+</ul>
+
+</body>
+</html>'''
+
+
+GROUP_TEMPLATE = '''
+<li><a href="%s">%s</a> (%d questions)</li>
+'''
+
+
+def make_html_index(shards, filepath):
+    """
+    Write a page linking to the preview of each group.
+    'shards' is a list of (group, preview filename, number of questions).
+    """
+    groups_html = ''.join(GROUP_TEMPLATE % (filename, cgi.escape(group), questions)
+                          for group, filename, questions in shards)
+    
+    with open(filepath, 'w') as htmlfile:
+        htmlfile.write(INDEX_TEMPLATE % groups_html)
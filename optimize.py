@@ -0,0 +1,40 @@
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def optimize_png(filepath, colors=256):
+    """
+    Quantize a PNG image to a palette of 'colors' colors and
+    recompress it. The file is only replaced if it gets smaller,
+    and is replaced by a rename, so hard links to it are kept intact.
+    Returns the number of bytes saved.
+    Requires Pillow.
+    """
+    if Image is None:
+        raise RuntimeError('Optimizing PNG images requires Pillow')
+
+    size = os.path.getsize(filepath)
+    image = Image.open(filepath)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    image = image.quantize(colors)
+
+    # Smallest bit depth which holds the palette
+    bits = 1
+    while 2 ** bits < colors:
+        bits *= 2
+
+    tmp = '%s.%d.tmp' % (filepath, os.getpid())
+    image.save(tmp, 'PNG', optimize=True, bits=bits)
+    optimized_size = os.path.getsize(tmp)
+
+    if optimized_size >= size:
+        os.remove(tmp)
+        return 0
+
+    os.rename(tmp, filepath)
+    return size - optimized_size
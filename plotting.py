@@ -1,23 +1,29 @@
 from matplotlib import rc, rcParams
 from helpers import latex
+from tex import (set_latex_cache, warm_latex_cache, enable_latex_format,
+                 enable_mathtext_fast_path)
 
 
 def pi2in(pixels):
     """
     Converts pixels to inches
     """
-    return float(pixels) / DPI
+    return float(pixels) * SCALE / DPI
 
 
 def in2pi(inches):
     """
     Converts inches to pixels
     """
-    return int(float(inches) * DPI)
+    return int(float(inches) * DPI / SCALE)
 
 
 DPI = 72.
 
+# While drawing images at a higher resolution, DPI is SCALE times
+# its usual value. Pixels are still converted at the usual DPI.
+SCALE = 1
+
 QUESTION_WIDTH = 600
 QUESTION_HEIGHT = 600
 QUESTION_FIGSIZE = (
@@ -1,10 +1,60 @@
 import random
-from xml.dom import minidom
 
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
+from matplotlib.collections import PatchCollection
+from matplotlib.colors import colorConverter, is_color_like
 
-from question import QuestionBase, AnswerBase
+from report import XMLReport
+from question import QuestionBase, AnswerBase, _overrides, _similarity_lookup
+
+
+# Tiles may overlap or exceed the tile area by this much, as their
+# bounds are computed in floating point
+TILE_TOLERANCE = 1e-9
+
+
+def _overlapping(bounds):
+    """
+    Iterate over pairs (i, j) of overlapping rectangles in bounds, which
+    is a list of (left, bottom, width, height). Rectangles are swept
+    from left to right, so only rectangles overlapping along x are
+    compared. Rectangles sharing an edge, up to TILE_TOLERANCE,
+    do not overlap.
+    """
+    active = []
+    for i in sorted(range(len(bounds)), key=lambda i: bounds[i][0]):
+        left, bottom, width, height = bounds[i]
+        active = [j for j in active
+                  if bounds[j][0] + bounds[j][2] > left + TILE_TOLERANCE]
+        
+        for j in active:
+            if (bottom + TILE_TOLERANCE < bounds[j][1] + bounds[j][3]
+                and bounds[j][1] + TILE_TOLERANCE < bottom + height):
+                yield j, i
+        
+        active.append(i)
+
+
+def _tile_style(fig, color='w', alpha=0.5):
+    """
+    Returns the arguments of PuzzleTileBase.draw(), with their defaults.
+    """
+    return fig, color, alpha
+
+
+def _per_tile(value, name, count):
+    """
+    Returns a list of count values of a draw_tiles() argument,
+    which is either a list or tuple with a value per tile, or one value
+    for all tiles. A list or tuple which is a color is one value.
+    """
+    if not isinstance(value, (list, tuple)) or (name == 'color' and is_color_like(value)):
+        return [value] * count
+    if len(value) != count:
+        raise ValueError('draw_tiles() got %d values of %s for %d tiles' % (
+            len(value), name, count))
+    return list(value)
 
 
 class PuzzleQuestionBase(QuestionBase):
@@ -14,9 +64,50 @@ class PuzzleQuestionBase(QuestionBase):
         """
         raise NotImplementedError('Question must implement get_tiles()')
     
+    def is_correct_answer(self, answer):
+        """
+        Returns True if answer is the correct answer to
+        any tile of this question, False otherwise.
+        """
+        return len(self._correct_tiles(answer)) > 0
+    
     def draw_tiles(self, *args, **kwargs):
-        for tile in self.make_tiles():
-            tile.draw(*args, **kwargs)
+        """
+        Draw all tiles on a figure, with the arguments of
+        PuzzleTileBase.draw(): draw_tiles(fig, color='w', alpha=0.5).
+        Tiles are drawn as a single collection in a single axes.
+        color and alpha may be lists or tuples giving a value for each tile,
+        unless color is a color itself, like (1, 0, 0).
+        If a tile class overrides draw(), tiles are drawn one at a time
+        and all arguments are passed on to draw() as they are.
+        """
+        tiles = self._get_tiles()
+        if any(_overrides(type(tile), PuzzleTileBase, 'draw') for tile in tiles):
+            for tile in tiles:
+                tile.draw(*args, **kwargs)
+            return
+        
+        fig, color, alpha = _tile_style(*args, **kwargs)
+        colors = _per_tile(color, 'color', len(tiles))
+        alphas = _per_tile(alpha, 'alpha', len(tiles))
+        
+        rects = []
+        rgba = []
+        for tile, color, alpha in zip(tiles, colors, alphas):
+            left, bottom, width, height = tile._bounds()
+            rects.append(Rectangle((left, bottom), width, height))
+            rgba.append(colorConverter.to_rgba(color, alpha))
+        
+        collection = PatchCollection(
+            rects,
+            facecolors=rgba,
+            edgecolors=rgba,
+            linestyles='dashed',
+        )
+        
+        ax = fig.add_subplot(111, alpha=0.0)
+        ax.axis('off')
+        ax.add_collection(collection)
     
     def most_favorable_answer(self, answer1, answer2):
         """
@@ -38,36 +129,47 @@ class PuzzleQuestionBase(QuestionBase):
             return random.choice([-1, 1])
     
     def favorized_answers(self, all_answers):
-        num_answers = self.num_answers_nomalized()
-        max_sim = self.max_similarity()
+        tiles = self._get_tiles()
+        tile_answers = [[] for tile in tiles]
+        available_answers = []
         
-        available_answers = [a for a in all_answers]
-        correct_answers = []
+        for answer in all_answers:
+            correct_tiles = self._correct_tiles(answer)
+            if correct_tiles:
+                tile_answers[correct_tiles[0]].append(answer)
+            else:
+                available_answers.append(answer)
         
-        for tile in self._get_tiles():
-            for answer in available_answers:
-                if tile.is_correct_answer(answer):
-                    correct_answers.append(answer)
-                    available_answers.remove(answer)
+        # Correct answers first, in the order of their tiles
+        correct_answers = [answer for answers in tile_answers for answer in answers]
         
         # Sort answers so that most favorable answers are first in the list
-        return correct_answers + sorted(available_answers, 
-                                        cmp=self.most_favorable_answer)
+        if _overrides(type(self), PuzzleQuestionBase, 'most_favorable_answer'):
+            available_answers.sort(cmp=self.most_favorable_answer)
+        else:
+            keyed = [(-self.proximate(answer), random.random(), i, answer)
+                     for i, answer in enumerate(available_answers)]
+            available_answers = [answer for apr, r, i, answer in sorted(keyed)]
+        
+        return correct_answers + available_answers
 
     def pick_answers(self, all_answers):
         """
         Picks answers for this question.
         """
         picked_answers = []
+        num_answers = self.num_answers_nomalized()
+        max_sim = self.max_similarity()
+        similarity = _similarity_lookup(all_answers)
         
         # Pick questions that are not too similar
         for answer in self.favorized_answers(all_answers):
             is_too_similar = False
             
             for a in picked_answers:
-                if a.similarity(answer) > max_sim:
+                if similarity(a, answer) > max_sim:
                     is_too_similar = True
-                    print 'Too similar: %s AND %s' % (a.vector, answer.vector)
+                    print 'Too similar: %s AND %s' % (str(a), str(answer))
                     break
             
             if not is_too_similar:
@@ -83,25 +185,101 @@ class PuzzleQuestionBase(QuestionBase):
         Check whether question has enough correct answers.
         Raises an exception if it doesn't.
         """
-        for tile in self._get_tiles():
-            has_correct_answer = False
-            
-            for answer in picked_answers:
-                if tile.is_correct_answer(answer):
-                    has_correct_answer = True
-                    break
-            
-            if not has_correct_answer:
+        for tile, answer in zip(self._get_tiles(), self._tile_answers(picked_answers)):
+            if answer is None:
                 raise RuntimeError('Tile does not have correct answer: %s' % str(tile))
     
+    def tile_area(self):
+        """
+        Returns (left, bottom, right, top) of the area tiles must be placed
+        within, or None if tiles may be placed anywhere.
+        Defaults to the whole figure, (0, 0, 1, 1), which is the area
+        draw_tiles() draws on.
+        """
+        return (0.0, 0.0, 1.0, 1.0)
+    
+    def allow_overlapping_tiles(self):
+        """
+        Returns True if tiles of this question may overlap, False otherwise.
+        """
+        return False
+    
+    def validate_layout(self):
+        """
+        Check whether tiles are within the tile area and do not overlap.
+        Raises an exception if they aren't.
+        """
+        tiles = self._get_tiles()
+        bounds = [tile._bounds() for tile in tiles]
+        
+        area = self.tile_area()
+        if area is not None:
+            area_left, area_bottom, area_right, area_top = area
+            for tile, (left, bottom, width, height) in zip(tiles, bounds):
+                if (left < area_left - TILE_TOLERANCE
+                    or bottom < area_bottom - TILE_TOLERANCE
+                    or left + width > area_right + TILE_TOLERANCE
+                    or bottom + height > area_top + TILE_TOLERANCE):
+                    raise RuntimeError('Tile is outside the tile area of question %s: %s' % (
+                        str(self), str(tile)))
+        
+        if not self.allow_overlapping_tiles():
+            for i, j in _overlapping(bounds):
+                raise RuntimeError('Tiles overlap in question %s: %s and %s' % (
+                    str(self), str(tiles[i]), str(tiles[j])))
+    
     def _get_tiles(self):
         """
-        Iterate over all tiles from a question
+        Returns all tiles from a question.
+        make_tiles() is only invoked once per question.
+        """
+        tiles = self.__dict__.get('_tiles')
+        if tiles is None:
+            tiles = list(self.make_tiles())
+            for tile in tiles:
+                if not isinstance(tile, PuzzleTileBase):
+                    raise RuntimeError('Tile MUST inherit from PuzzleTileBase')
+            self._tiles = tiles
+        return tiles
+    
+    def _clear_caches(self):
+        """
+        Internal method - do not overwrite!
+        Also forgets the tiles and which answers fit them.
+        """
+        QuestionBase._clear_caches(self)
+        self.__dict__.pop('_tiles', None)
+        self.__dict__.pop('_tile_index', None)
+    
+    def _correct_tiles(self, answer):
+        """
+        Returns the indices of the tiles answer is correct for.
+        Tiles are only asked once per answer.
+        """
+        index = self.__dict__.get('_tile_index')
+        if index is None:
+            index = self._tile_index = {}
+        
+        try:
+            return index[id(answer)][1]
+        except KeyError:
+            correct_tiles = [i for i, tile in enumerate(self._get_tiles())
+                             if tile.is_correct_answer(answer)]
+            # The answer is kept, so its id is not reused
+            index[id(answer)] = (answer, correct_tiles)
+            return correct_tiles
+    
+    def _tile_answers(self, answers):
         """
-        for tile in self.make_tiles():
-            if not isinstance(tile, PuzzleTileBase):
-                raise RuntimeError('Tile MUST inherit from PuzzleTileBase')
-            yield tile
+        Returns the first of answers which is correct for each tile,
+        or None for tiles without a correct answer.
+        """
+        tile_answers = [None] * len(self._get_tiles())
+        for answer in answers:
+            for i in self._correct_tiles(answer):
+                if tile_answers[i] is None:
+                    tile_answers[i] = answer
+        return tile_answers
 
 
 class PuzzleAnswerBase(AnswerBase):
@@ -136,19 +314,27 @@ class PuzzleTileBase(object):
     def scaling(self):
         return 1.0
     
-    def draw(self, fig, color='w', alpha=0.5):
+    def _bounds(self):
+        """
+        Returns (left, bottom, width, height) of the tile.
+        """
         center_x = float(self.center_x())
         center_y = float(self.center_y())
         width = float(self.width())
         height = float(self.height())
         
-        btn_left = (
+        return (
             center_x - (width / 2),
             center_y - (height / 2),
+            width,
+            height,
         )
+    
+    def draw(self, fig, color='w', alpha=0.5):
+        left, bottom, width, height = self._bounds()
         
         rect = Rectangle(
-            btn_left,
+            (left, bottom),
             width,
             height,
             alpha=alpha, 
@@ -161,35 +347,42 @@ class PuzzleTileBase(object):
         ax.add_patch(rect)
 
 
-class PuzzleXMLReport(object):
+class PuzzleXMLReport(XMLReport):
     def __init__(self, sort_questions_randomly):
-        self._doc = minidom.Document()
-        self._root = self._doc.createElement('root')
-        self._root.setAttribute('type', 'puzzle')
-        self._root.setAttribute('sort_questions_randomly',
-                                '1' if sort_questions_randomly else '0')
-        self._doc.appendChild(self._root)
+        XMLReport.__init__(self, 'puzzle', sort_questions_randomly)
     
     def add_question(self, question, answers):
         """
         Add a question and its answers to the report.
         """
         q = self._doc.createElement('question')
-        q.setAttribute('filename', question._filename)
+        sort_answers_randomly = question.sort_answers_randomly()
         q.setAttribute('sort_answers_randomly', 
-                    '1' if question.sort_answers_randomly() else '0')
+                    '1' if sort_answers_randomly else '0')
+        
+        record = {
+            'sort_answers_randomly': bool(sort_answers_randomly),
+            'answers': [],
+            'tiles': [],
+        }
+        self._set_filename(q, record, question)
         
         # Write answers
         ans = self._doc.createElement('answers')
         for i, answer in enumerate(sorted(answers)):
             a = self._doc.createElement('answer')
-            a.setAttribute('filename', answer._filename)
             a.setAttribute('sort', str(i))
             ans.appendChild(a)
+            
+            answer_record = {
+                'sort': i,
+            }
+            self._set_filename(a, answer_record, answer)
+            record['answers'].append(answer_record)
         
         # Write tiles
         til = self._doc.createElement('tiles')
-        for tile in question.make_tiles():
+        for tile, answer in zip(question._get_tiles(), question._tile_answers(answers)):
             t = self._doc.createElement('tile')
             t.setAttribute('center_x', str(tile.center_x()))
             t.setAttribute('center_y', str(tile.center_y()))
@@ -197,19 +390,22 @@ class PuzzleXMLReport(object):
             t.setAttribute('height', str(tile.height()))
             t.setAttribute('scaling', str(tile.scaling()))
             
-            for answer in answers:
-                if tile.is_correct_answer(answer):
-                    t.setAttribute('answer', answer._filename)
-                    break
+            tile_record = {
+                'center_x': float(tile.center_x()),
+                'center_y': float(tile.center_y()),
+                'width': float(tile.width()),
+                'height': float(tile.height()),
+                'scaling': float(tile.scaling()),
+            }
+            
+            if answer is not None:
+                t.setAttribute('answer', answer._filename)
+                tile_record['answer'] = answer._filename
             
             til.appendChild(t)
+            record['tiles'].append(tile_record)
         
         q.appendChild(ans)
         q.appendChild(til)
         
-        self._root.appendChild(q)
-    
-    def save(self, to_file):
-        with open(to_file, 'w') as f:
-            xml_str = self._doc.toprettyxml(indent='  ')
-            f.write(xml_str)
+        self._add(q, record)
@@ -1,5 +1,7 @@
 import random
 
+import numpy as np
+
 
 def _repr_obj(obj):
     """
@@ -16,6 +18,138 @@ def _repr_obj(obj):
     return s.replace('\n', ' ')
 
 
+def _overrides(cls, base, name):
+    """
+    Returns True if cls overrides the method 'name' of base.
+    """
+    return getattr(cls, name).__func__ is not getattr(base, name).__func__
+
+
+# Groups with at most this many answers get a dense similarity matrix
+# computed from their feature vectors.
+DENSE_SIMILARITY_ANSWERS = 2000
+
+
+def _feature_vectors(items):
+    """
+    Returns the feature vectors of items as the rows of an array,
+    or None if an item has no feature vector.
+    """
+    vectors = []
+    for item in items:
+        vector = item.feature_vector()
+        if vector is None:
+            return None
+        vectors.append(np.ravel(np.asarray(vector, dtype=float)))
+    
+    if not vectors:
+        return None
+    return np.vstack(vectors)
+
+
+def _vector_proximity(u, v):
+    """
+    Proximity of two feature vectors: 1 / (1 + distance).
+    """
+    return 1.0 / (1.0 + np.sqrt(np.sum((u - v) ** 2)))
+
+
+def _vector_proximity_matrix(u, v):
+    """
+    Proximity between each row of u and each row of v.
+    """
+    squared = ((u ** 2).sum(axis=1)[:, np.newaxis]
+               + (v ** 2).sum(axis=1)[np.newaxis, :]
+               - 2 * np.dot(u, v.T))
+    return 1.0 / (1.0 + np.sqrt(np.maximum(squared, 0)))
+
+
+def _default_proximity(item1, item2):
+    """
+    Proximity of the feature vectors of two items, or 0 if
+    either has no feature vector.
+    """
+    u = item1.feature_vector()
+    v = item2.feature_vector()
+    if u is None or v is None:
+        return 0
+    return _vector_proximity(np.ravel(np.asarray(u, dtype=float)),
+                             np.ravel(np.asarray(v, dtype=float)))
+
+
+def _similarity_lookup(all_answers):
+    """
+    Returns a function f(a, b) giving a.similarity(b), which is cached
+    if all_answers carries the SimilarityCache of its group.
+    """
+    similarities = getattr(all_answers, 'similarities', None)
+    if similarities is not None:
+        return similarities.similarity
+    return lambda a, b: a.similarity(b)
+
+
+class SimilarityCache(object):
+    """
+    Similarities between the answers of a group, shared by all questions
+    in the group. Each pair of answers is compared at most once.
+    The answer class may supply all similarities at once by implementing
+    similarity_matrix(), or by implementing feature_vector() and not
+    similarity().
+    """
+    def __init__(self, answers):
+        self._answers = list(answers)
+        self._index = dict((id(answer), i) for i, answer in enumerate(self._answers))
+        self._matrix = None
+        self._vectors = None
+        self._matrix_built = False
+        self._cache = {}
+    
+    def _build_matrix(self):
+        self._matrix_built = True
+        if not self._answers:
+            return
+        
+        cls = type(self._answers[0])
+        if any(type(answer) is not cls for answer in self._answers):
+            return
+        
+        matrix = cls.similarity_matrix(self._answers)
+        if matrix is not None:
+            shape = (len(self._answers), len(self._answers))
+            if np.shape(matrix) != shape:
+                raise RuntimeError('similarity_matrix() must return a matrix of shape %s (got %s)' % (
+                    str(shape), str(np.shape(matrix))))
+            self._matrix = np.asarray(matrix)
+        elif not _overrides(cls, AnswerBase, 'similarity'):
+            vectors = _feature_vectors(self._answers)
+            if vectors is not None and len(vectors) <= DENSE_SIMILARITY_ANSWERS:
+                self._matrix = _vector_proximity_matrix(vectors, vectors)
+            else:
+                self._vectors = vectors
+    
+    def similarity(self, a, b):
+        """
+        Returns a.similarity(b).
+        """
+        i = self._index.get(id(a))
+        j = self._index.get(id(b))
+        if i is None or j is None:
+            return a.similarity(b)
+        
+        if not self._matrix_built:
+            self._build_matrix()
+        if self._matrix is not None:
+            return self._matrix[i, j]
+        if self._vectors is not None:
+            return _vector_proximity(self._vectors[i], self._vectors[j])
+        
+        try:
+            return self._cache[i, j]
+        except KeyError:
+            value = self._cache[i, j] = a.similarity(b)
+            return value
+
+
 class QuestionBase(object):
     _default_group = 'Default'
     
@@ -51,6 +185,15 @@ class QuestionBase(object):
         """
         raise NotImplementedError('Question must implement is_same_as()')
     
+    def dedup_key(self):
+        """
+        Returns a hashable key used to look up duplicate questions,
+        or None to compare with every other question.
+        Questions that are the same MUST have the same key, as only
+        questions with equal keys are compared using is_same_as().
+        """
+        return None
+    
     def get_class(self):
         """
         Returns question group name.
@@ -96,12 +239,21 @@ class QuestionBase(object):
         """
         return 0
     
+    def feature_vector(self):
+        """
+        Optionally returns a numeric vector describing the question,
+        comparable to the feature vectors of its answers.
+        """
+        return None
+    
     def proximate(self, answer):
         """
         Approximate how close an answer is to the question asked.
         Return value must be a float n, where 0 <= n <= 1.
+        Defaults to 1 / (1 + distance) between the feature vectors of
+        the question and answer, or 0 if either has none.
         """
-        return 0
+        return _default_proximity(self, answer)
     
     def max_similarity(self):
         """
@@ -120,8 +272,55 @@ class QuestionBase(object):
         """
         Approximate how close a correct answer is to the question asked.
         Return value must be a float n, where 0 <= n <= 1.
+        Defaults to the same as proximate().
         """
-        return 0
+        return _default_proximity(self, answer)
+    
+    def cache_correctness(self):
+        """
+        Returns True if is_correct_answer() always gives the same result
+        for the same answer, so the result may be reused throughout the
+        build. Return False for non-deterministic questions.
+        """
+        return True
+    
+    def _is_correct(self, answer):
+        """
+        Internal method - do not overwrite!
+        Returns is_correct_answer(answer), cached per answer object.
+        """
+        cache = self.__dict__.get('_correctness')
+        if cache is None:
+            if not self.cache_correctness():
+                return self.is_correct_answer(answer)
+            cache = self._correctness = {}
+        
+        try:
+            return cache[id(answer)][1]
+        except KeyError:
+            is_correct = self.is_correct_answer(answer)
+            # The answer is kept, so its id is not reused
+            cache[id(answer)] = (answer, is_correct)
+            return is_correct
+    
+    def _clear_caches(self):
+        """
+        Internal method - do not overwrite!
+        Forgets the cached results of is_correct_answer(), and the
+        answers they keep, once the question is reported.
+        """
+        self.__dict__.pop('_correctness', None)
+    
+    def _remember_correctness(self, answer, is_correct):
+        """
+        Internal method - do not overwrite!
+        Adds a known result of is_correct_answer(answer) to the cache.
+        """
+        if '_correctness' not in self.__dict__:
+            if not self.cache_correctness():
+                return
+            self._correctness = {}
+        self._correctness[id(answer)] = (answer, is_correct)
     
     def make_answers(self):
         """
@@ -172,6 +371,22 @@ class QuestionBase(object):
         """
         raise NotImplementedError
     
+    def validate_layout(self):
+        """
+        Check whether the question can be laid out properly.
+        Raises an exception if it can't.
+        """
+        pass
+    
+    @classmethod
+    def pick_group_answers(cls, questions, all_answers):
+        """
+        Picks answers for all questions in a group at once.
+        Returns a list with the picked answers of each question, or None
+        to pick answers for one question at a time using pick_answers().
+        """
+        return None
+    
     # -------------------------------------------------------------------------
     
     # Legacy
@@ -206,12 +421,39 @@ class AnswerBase(object):
         """
         raise NotImplementedError('Answer must implement is_same_as()')
     
+    def dedup_key(self):
+        """
+        Returns a hashable key used to look up duplicate answers,
+        or None to compare with every other answer.
+        Answers that are the same MUST have the same key, as only
+        answers with equal keys are compared using is_same_as().
+        """
+        return None
+    
+    def feature_vector(self):
+        """
+        Optionally returns a numeric vector describing the answer.
+        Answers with feature vectors are compared in batches using NumPy.
+        """
+        return None
+    
     def similarity(self, other_answer):
         """
         Approximate how similar this answer is to another answer.
         Return value must be a float n, where 0 <= n <= 1.
+        Defaults to 1 / (1 + distance) between the feature vectors of
+        the answers, or 0 if either has none.
         """
-        return 0
+        return _default_proximity(self, other_answer)
+    
+    @classmethod
+    def similarity_matrix(cls, answers):
+        """
+        Optional batch version of similarity() for a group.
+        Returns a NumPy array, where element [i, j] is
+        answers[i].similarity(answers[j]), or None if not implemented.
+        """
+        return None
     
     def is_less_than(self, other_answer):
         """
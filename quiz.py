@@ -1,7 +1,32 @@
+import heapq
 import random
-from xml.dom import minidom
 
-from question import QuestionBase, AnswerBase
+import numpy as np
+
+from report import XMLReport
+from question import (QuestionBase, AnswerBase, _overrides, _similarity_lookup,
+                      _feature_vectors, _vector_proximity_matrix)
+
+
+def _check_matrix(name, matrix, shape):
+    if np.shape(matrix) != shape:
+        raise RuntimeError('%s() must return a matrix of shape %s (got %s)' % (
+            name, str(shape), str(np.shape(matrix))))
+    return np.asarray(matrix)
+
+
+def _feature_vector_proximity(questions, answers):
+    """
+    Proximity matrix between the feature vectors of questions and answers,
+    or None if some of them have no feature vector.
+    """
+    u = _feature_vectors(questions)
+    if u is None:
+        return None
+    v = _feature_vectors(answers)
+    if v is None:
+        return None
+    return _vector_proximity_matrix(u, v)
 
 
 class QuizQuestionBase(QuestionBase):
@@ -21,7 +46,7 @@ class QuizQuestionBase(QuestionBase):
         Returns 0 if answer1 and answer2 are equal.
         Returns 1 if answer1 is less favorable than answer2.
         """
-        if self.is_correct_answer(answer1) and self.is_correct_answer(answer2):
+        if self._is_correct(answer1) and self._is_correct(answer2):
             apr1 = self.correct_answer_proximate(answer1)
             apr2 = self.correct_answer_proximate(answer2)
             if apr1 > apr2:
@@ -30,9 +55,9 @@ class QuizQuestionBase(QuestionBase):
                 return 1
             else:
                 return random.choice([-1, 1])            
-        elif self.is_correct_answer(answer1):
+        elif self._is_correct(answer1):
             return -1
-        elif self.is_correct_answer(answer2):
+        elif self._is_correct(answer2):
             return 1
         
         apr1 = self.proximate(answer1) 
@@ -51,32 +76,77 @@ class QuizQuestionBase(QuestionBase):
         of answers, where the first elements (answers) are the most favored.
         Do not edit the original list 'all_answers' - in stead create a new!
         """
-        return sorted(all_answers, cmp=self.most_favorable_answer)
+        if _overrides(type(self), QuizQuestionBase, 'most_favorable_answer'):
+            return sorted(all_answers, cmp=self.most_favorable_answer)
+        
+        keyed = [(self._favorability_key(answer)[0], i, answer)
+                 for i, answer in enumerate(all_answers)]
+        return [answer for key, i, answer in sorted(keyed)]
+    
+    def _favorability_key(self, answer):
+        """
+        Returns (key, is_correct) for an answer. Answers with lower keys
+        are more favorable, in the order of most_favorable_answer().
+        Equally favorable answers are ordered randomly.
+        """
+        if self._is_correct(answer):
+            return (0, -self.correct_answer_proximate(answer), random.random()), True
+        return (1, -self.proximate(answer), random.random()), False
+    
+    def _iter_favorized_answers(self, all_answers):
+        """
+        Iterate over (answer, is_correct), most favored answers first.
+        Each answer is scored once, and answers are only sorted
+        as far as they are iterated.
+        """
+        if (_overrides(type(self), QuizQuestionBase, 'favorized_answers')
+            or _overrides(type(self), QuizQuestionBase, 'most_favorable_answer')):
+            # Give a copy of the list to favorized_answers, so the
+            # method can't mutate the all_answers.
+            for answer in self.favorized_answers(list(all_answers)):
+                yield answer, self._is_correct(answer)
+            return
+        
+        heap = []
+        for i, answer in enumerate(all_answers):
+            key, is_correct = self._favorability_key(answer)
+            heap.append((key, i, answer, is_correct))
+        heapq.heapify(heap)
+        
+        while heap:
+            key, i, answer, is_correct = heapq.heappop(heap)
+            yield answer, is_correct
     
     def pick_answers(self, all_answers):
         """
         Picks answers for this question.
         """
+        return self._pick_from(self._iter_favorized_answers(all_answers),
+                               _similarity_lookup(all_answers))
+    
+    def _pick_from(self, favorized_answers, similarity):
+        """
+        Picks answers from an iterator of (answer, is_correct),
+        most favored answers first. similarity(a, b) returns
+        a.similarity(b).
+        """
         picked_answers = []
         num_answers = self.num_answers_nomalized()
         max_sim = self.max_similarity()
         max_ans = self.maximum_correct_answers()
         
         # Pick questions that are not too similar
-        # Give a copy of the list to favorized_answers, so the
-        # method can't mutate the all_answers.
-
         num_correct_ans = 0
-        for answer in self.favorized_answers(list(all_answers)):
+        for answer, is_correct in favorized_answers:
             is_too_similar = False
             is_not_too_correct = True
             
             for a in picked_answers:
-                if a.similarity(answer) > max_sim:
+                if similarity(a, answer) > max_sim:
                     is_too_similar = True
                     break            
 
-            if self.is_correct_answer(answer):
+            if is_correct:
                 is_not_too_correct = num_correct_ans < max_ans
                 if is_not_too_correct:
                     num_correct_ans += 1
@@ -91,6 +161,100 @@ class QuizQuestionBase(QuestionBase):
             
         return sorted(picked_answers[:num_answers])
     
+    @classmethod
+    def proximate_matrix(cls, questions, answers):
+        """
+        Optional batch version of proximate() for a group.
+        Returns a NumPy array, where element [i, j] is
+        questions[i].proximate(answers[j]), or None if not implemented.
+        Computed from feature vectors if proximate() is not overridden.
+        """
+        if _overrides(cls, QuestionBase, 'proximate'):
+            return None
+        return _feature_vector_proximity(questions, answers)
+    
+    @classmethod
+    def correctness_matrix(cls, questions, answers):
+        """
+        Optional batch version of is_correct_answer() for a group.
+        Returns a boolean NumPy array, where element [i, j] is
+        questions[i].is_correct_answer(answers[j]), or None if not implemented.
+        """
+        return None
+    
+    @classmethod
+    def correct_answer_proximate_matrix(cls, questions, answers):
+        """
+        Optional batch version of correct_answer_proximate() for a group.
+        Returns a NumPy array, where element [i, j] is
+        questions[i].correct_answer_proximate(answers[j]), or None if
+        not implemented. Only elements of correct answers are used.
+        Computed from feature vectors if correct_answer_proximate()
+        is not overridden.
+        """
+        if _overrides(cls, QuestionBase, 'correct_answer_proximate'):
+            return None
+        return _feature_vector_proximity(questions, answers)
+    
+    @classmethod
+    def pick_group_answers(cls, questions, all_answers):
+        """
+        Picks answers for all questions in a group at once, when
+        the questions implement proximate_matrix(). Answers are ordered
+        for every question by sorting the matrices, in the same order
+        as pick_answers() would pick them.
+        """
+        if any(type(question) is not cls for question in questions):
+            return None
+        for name in ('pick_answers', 'favorized_answers', 'most_favorable_answer'):
+            if _overrides(cls, QuizQuestionBase, name):
+                return None
+        
+        answers = list(all_answers)
+        shape = (len(questions), len(answers))
+        
+        proximity = cls.proximate_matrix(questions, answers)
+        if proximity is None:
+            return None
+        proximity = _check_matrix('proximate_matrix', proximity, shape)
+        
+        correct = cls.correctness_matrix(questions, answers)
+        remember_correctness = correct is not None
+        if correct is None:
+            correct = np.array([[question._is_correct(answer) for answer in answers]
+                                for question in questions], dtype=bool).reshape(shape)
+        correct = _check_matrix('correctness_matrix', correct, shape).astype(bool)
+        
+        correct_proximity = cls.correct_answer_proximate_matrix(questions, answers)
+        if correct_proximity is None:
+            correct_proximity = np.zeros(shape)
+            for i, j in zip(*np.nonzero(correct)):
+                correct_proximity[i, j] = questions[i].correct_answer_proximate(answers[j])
+        correct_proximity = _check_matrix('correct_answer_proximate_matrix',
+                                          correct_proximity, shape)
+        
+        # Correct answers first, then most proximate, then random
+        score = np.where(correct, correct_proximity, proximity)
+        tiebreak = np.array([[random.random() for j in xrange(shape[1])]
+                             for i in xrange(shape[0])]).reshape(shape)
+        
+        similarity = _similarity_lookup(all_answers)
+        index = dict((id(answer), j) for j, answer in enumerate(answers))
+        
+        picked = []
+        for i, question in enumerate(questions):
+            order = np.lexsort((tiebreak[i], -score[i], ~correct[i]))
+            picked_answers = question._pick_from(
+                ((answers[j], correct[i, j]) for j in order), similarity)
+            
+            # Validation and reports only need the picked answers
+            if remember_correctness:
+                for answer in picked_answers:
+                    question._remember_correctness(
+                        answer, bool(correct[i, index[id(answer)]]))
+            picked.append(picked_answers)
+        return picked
+    
     def validate_answers(self, picked_answers):
         """
         Check whether question has enough correct answers.
@@ -98,7 +262,7 @@ class QuizQuestionBase(QuestionBase):
         """
         correct_required = self.required_correct_answers()
         correct_answers = [a for a in picked_answers if 
-                            self.is_correct_answer(a)]
+                            self._is_correct(a)]
         
         if len(correct_answers) < correct_required:
             raise RuntimeError('Question does not have enough correct answers: %s \n (%s found, %s required)' % (
@@ -111,41 +275,45 @@ class QuizAnswerBase(AnswerBase):
     pass
 
 
-class QuizXMLReport(object):
+class QuizXMLReport(XMLReport):
     def __init__(self, sort_questions_randomly):
-        self._doc = minidom.Document()
-        self._root = self._doc.createElement('root')
-        self._root.setAttribute('type', 'quiz')
-        self._root.setAttribute('sort_questions_randomly',
-                                '1' if sort_questions_randomly else '0')
-        self._doc.appendChild(self._root)
+        XMLReport.__init__(self, 'quiz', sort_questions_randomly)
     
     def add_question(self, question, answers):
         """
         Add a question and its answers to the report.
         """
         q = self._doc.createElement('question')
-        q.setAttribute('filename', question._filename)
         req_corr_ans = question.required_correct_answers()
         if req_corr_ans == 0:
             req_corr_ans = question.number_of_correct_answers                           
         q.setAttribute('required_correct_answers', 
                        str(req_corr_ans))
+        sort_answers_randomly = question.sort_answers_randomly()
         q.setAttribute('sort_answers_randomly', 
-                       '1' if question.sort_answers_randomly() else '0')
+                       '1' if sort_answers_randomly else '0')
+        
+        record = {
+            'required_correct_answers': int(req_corr_ans),
+            'sort_answers_randomly': bool(sort_answers_randomly),
+            'answers': [],
+        }
+        self._set_filename(q, record, question)
         
         # Write answers
         for i, answer in enumerate(sorted(answers)):
+            is_correct = question._is_correct(answer)
             a = self._doc.createElement('answer')
-            a.setAttribute('filename', answer._filename)
             a.setAttribute('sort', str(i))
             a.setAttribute('is_correct',
-                           '1' if question.is_correct_answer(answer) else '0')
+                           '1' if is_correct else '0')
             q.appendChild(a)
+            
+            answer_record = {
+                'sort': i,
+                'is_correct': bool(is_correct),
+            }
+            self._set_filename(a, answer_record, answer)
+            record['answers'].append(answer_record)
         
-        self._root.appendChild(q)
-    
-    def save(self, to_file):
-        with open(to_file, 'w') as f:
-            xml_str = self._doc.toprettyxml(indent='  ')
-            f.write(xml_str)
+        self._add(q, record)
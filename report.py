@@ -0,0 +1,228 @@
+import os
+import json
+from StringIO import StringIO
+from xml.dom import minidom, pulldom
+
+
+def read_jsonl(from_file):
+    """
+    Read a report written as JSON lines.
+    Returns the report settings and an iterator over the questions,
+    which are read from the file one at a time.
+    """
+    f = open(from_file)
+    settings = json.loads(f.readline())
+
+    def questions():
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    return settings, questions()
+
+
+def _strip_whitespace(node):
+    """
+    Remove the indentation text nodes of a parsed element.
+    """
+    for child in list(node.childNodes):
+        if child.nodeType == child.TEXT_NODE and not child.data.strip():
+            node.removeChild(child)
+        else:
+            _strip_whitespace(child)
+
+
+def variant_name(scale):
+    """
+    Returns the name of the attribute holding the filename of
+    an image in another resolution, e.g. filename_2x.
+    """
+    return 'filename_%gx' % scale
+
+
+def _replace(from_file, to_file):
+    if os.path.abspath(from_file) != os.path.abspath(to_file):
+        if os.path.exists(to_file):
+            os.remove(to_file)
+        os.rename(from_file, to_file)
+
+
+class XMLReport(object):
+    """
+    Base class of XML reports.
+
+    Questions are kept in memory and written by save(), unless open()
+    is called first. The report is then written to the file as questions
+    are added, with exactly the same output.
+
+    The same data may be written as JSON lines using open_jsonl():
+    a line with the report settings followed by a line per question.
+    """
+    def __init__(self, report_type, sort_questions_randomly):
+        self._doc = minidom.Document()
+        self._root = self._doc.createElement('root')
+        self._root.setAttribute('type', report_type)
+        self._root.setAttribute('sort_questions_randomly',
+                                '1' if sort_questions_randomly else '0')
+        self._doc.appendChild(self._root)
+        self._settings = {
+            'type': report_type,
+            'sort_questions_randomly': bool(sort_questions_randomly),
+        }
+        self._file = None
+        self._jsonl_file = None
+        self._questions_written = 0
+    
+    def open(self, to_file):
+        """
+        Write questions to to_file as they are added.
+        """
+        self._file = open(to_file, 'w')
+        self._questions_written = 0
+        self._file.write('<?xml version="1.0" ?>\n')
+    
+    def open_jsonl(self, to_file):
+        """
+        Also write questions to to_file as JSON lines as they are added.
+        """
+        self._jsonl_file = open(to_file, 'w')
+        self._write_jsonl(self._settings)
+    
+    def _write_jsonl(self, record):
+        self._jsonl_file.write(json.dumps(record, sort_keys=True,
+                                          separators=(',', ':')))
+        self._jsonl_file.write('\n')
+    
+    def _add(self, element, record):
+        """
+        Add a question to the report, as an XML element and
+        as a dictionary for JSON lines.
+        """
+        if self._jsonl_file is not None and record is not None:
+            self._write_jsonl(record)
+        
+        if self._file is None:
+            self._root.appendChild(element)
+            return
+        
+        if self._questions_written == 0:
+            # Start tag of the (empty) root element
+            self._file.write(self._root_xml()[:-len('/>\n')] + '>\n')
+        
+        element.writexml(self._file, '  ', '  ', '\n')
+        element.unlink()
+        self._questions_written += 1
+    
+    def merge(self, from_file, keep, added=None):
+        """
+        Add the questions of an existing XML report, for which
+        keep(filename) returns True. The existing report is parsed
+        one question at a time. If given, added(element) is called
+        with each question element before it is added.
+        """
+        events = pulldom.parse(from_file)
+        for event, node in events:
+            if event == pulldom.START_ELEMENT and node.tagName == 'question':
+                events.expandNode(node)
+                if keep(node.getAttribute('filename')):
+                    _strip_whitespace(node)
+                    if added is not None:
+                        added(node)
+                    self._add(node, None)
+    
+    def merge_jsonl(self, from_file, keep):
+        """
+        Add the questions of an existing JSON lines report to the file
+        opened by open_jsonl(), for which keep(filename) returns True.
+        """
+        settings, questions = read_jsonl(from_file)
+        for record in questions:
+            if keep(record['filename']):
+                self._write_jsonl(record)
+    
+    def _set_filename(self, element, record, item):
+        """
+        Set the filename of an item's image, and of its variants in
+        other resolutions, on an XML element and its record.
+        """
+        element.setAttribute('filename', item._filename)
+        record['filename'] = item._filename
+        for scale, filename in getattr(item, '_variants', ()):
+            element.setAttribute(variant_name(scale), filename)
+            record[variant_name(scale)] = filename
+    
+    def _root_xml(self):
+        buf = StringIO()
+        self._root.writexml(buf, '', '  ', '\n')
+        return buf.getvalue()
+    
+    def finish(self):
+        """
+        Finish and close the files opened by open() and open_jsonl(),
+        once all questions are added. save() and save_jsonl() then
+        move them in place.
+        """
+        if self._file is not None and not self._file.closed:
+            if self._questions_written == 0:
+                self._file.write(self._root_xml())
+            else:
+                self._file.write('</root>\n')
+            self._file.close()
+        
+        if self._jsonl_file is not None:
+            self._jsonl_file.close()
+    
+    def save(self, to_file):
+        if self._file is None:
+            with open(to_file, 'w') as f:
+                xml_str = self._doc.toprettyxml(indent='  ')
+                f.write(xml_str)
+            return
+        
+        self.finish()
+        _replace(self._file.name, to_file)
+        self._file = None
+    
+    def save_jsonl(self, to_file):
+        """
+        Finish the file opened by open_jsonl() and move it to to_file.
+        """
+        self._jsonl_file.close()
+        _replace(self._jsonl_file.name, to_file)
+        self._jsonl_file = None
+    
+    def save_index(self, to_file, shards):
+        """
+        Write an index of reports of this type to to_file.
+        'shards' is a list of (group, [files], number of questions).
+        """
+        doc = minidom.Document()
+        root = doc.createElement('index')
+        for name in ('type', 'sort_questions_randomly'):
+            root.setAttribute(name, self._root.getAttribute(name))
+        doc.appendChild(root)
+        
+        for group, files, questions in shards:
+            shard = doc.createElement('shard')
+            shard.setAttribute('group', group)
+            shard.setAttribute('questions', str(questions))
+            for filename in files:
+                file_element = doc.createElement('file')
+                file_element.setAttribute('filename', filename)
+                shard.appendChild(file_element)
+            root.appendChild(shard)
+        
+        with open(to_file, 'w') as f:
+            f.write(doc.toprettyxml(indent='  '))
+    
+    def discard(self):
+        """
+        Delete the files opened by open() and open_jsonl().
+        """
+        for f in (self._file, self._jsonl_file):
+            if f is not None:
+                f.close()
+                if os.path.exists(f.name):
+                    os.remove(f.name)
+        self._file = None
+        self._jsonl_file = None
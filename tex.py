@@ -0,0 +1,492 @@
+import os
+import shutil
+import subprocess
+import hashlib
+import tempfile
+import struct
+
+import numpy as np
+import matplotlib
+from matplotlib import rcParams
+from matplotlib.text import Text
+from matplotlib.mathtext import MathTextParser
+from matplotlib.texmanager import TexManager
+
+
+_make_dvi = TexManager.make_dvi
+_run_checked_subprocess = TexManager._run_checked_subprocess
+_get_usetex = Text.get_usetex
+
+# Folder set by set_latex_cache(), with a subfolder for each settings key
+_folder = None
+
+# Formats of the preamble by their path, or None if one can't be built
+_formats = {}
+_latex_version = None
+
+# Whether mathtext can render a string, by string
+_mathtext_strings = {}
+_mathtext_parser = None
+_mathtext_fast_path = False
+
+# Number of strings LaTeX runs for at most in one batch
+LATEX_BATCH_SIZE = 500
+
+
+def _settings_key():
+    """
+    Returns a digest of the settings affecting LaTeX runs.
+    """
+    values = [matplotlib.__version__,
+              rcParams['text.latex.preamble'],
+              rcParams['text.latex.unicode'],
+              rcParams['font.family']]
+    for font_family in TexManager.font_families:
+        values.append(rcParams['font.' + font_family])
+
+    m = hashlib.sha1()
+    m.update(repr(values))
+    return m.hexdigest()[:16]
+
+
+def _settings_folder():
+    """
+    Returns the subfolder of the LaTeX cache for the current settings,
+    which is created if needed, and makes TexManager use it.
+    """
+    folder = os.path.join(_folder, _settings_key())
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(folder):
+                raise
+
+    TexManager.texcache = folder
+    return folder
+
+
+def _make_shared_dvi(self, tex, fontsize):
+    """
+    TexManager.make_dvi() which runs LaTeX in a folder of its own,
+    and moves the DVI file to the cache when it is done.
+    """
+    _settings_folder()
+    if rcParams['text.latex.preview']:
+        return _make_dvi(self, tex, fontsize)
+
+    basefile = self.get_basefile(tex, fontsize)
+    dvifile = '%s.dvi' % basefile
+    if os.path.exists(dvifile):
+        return dvifile
+
+    folder = tempfile.mkdtemp(prefix='tmp-', dir=self.texcache)
+    try:
+        # Files are written to, and LaTeX runs in, texcache
+        self.texcache = folder
+        try:
+            texfile = self.make_tex(tex, fontsize)
+            self._run_checked_subprocess(
+                ['latex', '-interaction=nonstopmode', '--halt-on-error',
+                 texfile], tex)
+        finally:
+            del self.texcache
+        os.rename('%s.dvi' % os.path.splitext(texfile)[0], dvifile)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return dvifile
+
+
+def _make_shared_png(self, tex, fontsize, dpi):
+    """
+    TexManager.make_png() which moves the PNG file to the cache
+    when it is done.
+    """
+    _settings_folder()
+    basefile = self.get_basefile(tex, fontsize, dpi)
+    pngfile = '%s.png' % basefile
+    if os.path.exists(pngfile):
+        return pngfile
+
+    dvifile = self.make_dvi(tex, fontsize)
+    tmp = '%s.%d.tmp' % (pngfile, os.getpid())
+    try:
+        self._run_checked_subprocess(
+            ['dvipng', '-bg', 'Transparent', '-D', str(dpi),
+             '-T', 'tight', '-o', tmp, dvifile], tex)
+        os.rename(tmp, pngfile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return pngfile
+
+
+def set_latex_cache(folder=None):
+    """
+    Keep the files of LaTeX runs for usetex text in 'folder', instead
+    of matplotlib's cache folder in the home directory. Files are placed
+    in a subfolder named by the LaTeX preamble, font settings and
+    matplotlib version, which are looked up on each LaTeX run, so
+    changing them later switches to another subfolder. Several processes
+    and machines may share the folder, as files only appear in it once
+    they are complete. Defaults to ~/.sci2u/tex_cache.
+    Returns the subfolder for the current settings.
+    """
+    global _folder
+
+    if folder is None:
+        folder = os.path.join(os.path.expanduser('~'), '.sci2u', 'tex_cache')
+    _folder = os.path.abspath(folder)
+    TexManager.make_dvi = _make_shared_dvi
+    TexManager.make_png = _make_shared_png
+    return _settings_folder()
+
+
+def warm_latex_cache(tex_strings, fontsize, dpi=None):
+    """
+    Run LaTeX for each string in 'tex_strings' at 'fontsize' (points),
+    and dvipng at 'dpi' if given, to fill the cache in advance.
+    Returns the number of strings LaTeX ran for.
+    """
+    return run_latex_batches([(tex, fontsize, dpi) for tex in tex_strings])
+
+
+def record_latex(function, *args):
+    """
+    Call function(*args) with LaTeX and dvipng replaced by recording
+    what they are run for, so usetex text comes out blank. Returns
+    the set of (string, fontsize, dpi) found, with dpi None for text
+    which is only measured.
+    """
+    jobs = set()
+
+    def get_text_width_height_descent(self, tex, fontsize, renderer=None):
+        if tex.strip() == '':
+            return 0, 0, 0
+        jobs.add((tex, fontsize, None))
+        return fontsize, fontsize, 0
+
+    def get_grey(self, tex, fontsize=None, dpi=None):
+        # Blank text would make no page of its own in a batch
+        if tex.strip() != '':
+            jobs.add((tex, fontsize, dpi))
+        return np.zeros((1, 1))
+
+    saved = (TexManager.__dict__['get_text_width_height_descent'],
+             TexManager.__dict__['get_grey'])
+    TexManager.get_text_width_height_descent = get_text_width_height_descent
+    TexManager.get_grey = get_grey
+    try:
+        function(*args)
+    finally:
+        TexManager.get_text_width_height_descent, TexManager.get_grey = saved
+    return jobs
+
+
+def _split_dvi(data):
+    """
+    Returns a DVI file for each page of the DVI file 'data', each with
+    the font definitions of the whole file.
+    """
+    data = data.rstrip('\xdf')
+    post_post = len(data) - 6
+    if post_post < 15 or data[post_post] != chr(249):
+        raise ValueError('Not a DVI file')
+    post = struct.unpack('>i', data[post_post + 1:post_post + 5])[0]
+    if data[post] != chr(248):
+        raise ValueError('Not a DVI file')
+    font_defs = data[post + 29:post_post]
+
+    # Pages are found from the last one by the pointer in each bop
+    bops = []
+    bop = struct.unpack('>i', data[post + 1:post + 5])[0]
+    while bop != -1:
+        if data[bop] != chr(139):
+            raise ValueError('Not a DVI file')
+        bops.insert(0, bop)
+        bop = struct.unpack('>i', data[bop + 41:bop + 45])[0]
+
+    pre = data[:15 + ord(data[14])]
+    pages = []
+    for bop, end in zip(bops, bops[1:] + [post]):
+        page = (pre + data[bop:bop + 41] + struct.pack('>i', -1)
+                + font_defs + data[bop + 45:end])
+        post_page = len(page)
+        page += (chr(248) + struct.pack('>i', len(pre)) + data[post + 5:post + 27]
+                 + struct.pack('>H', 1) + font_defs)
+        page += chr(249) + struct.pack('>i', post_page) + data[post_post + 5]
+        page += '\xdf' * (4 + (-len(page) - 4) % 4)
+        pages.append((struct.unpack('>i', data[bop + 1:bop + 5])[0], page))
+    return pages
+
+
+def _run_batch(texmanager, strings, dpis):
+    """
+    Run LaTeX once for the (string, fontsize) pairs in 'strings', one
+    page each, and split the DVI file into the file for each pair in the
+    cache. Then run dvipng once for each dpi in 'dpis', which maps it to
+    the pairs to make PNG files of.
+    """
+    names = [os.path.basename(texmanager.get_basefile(tex, fontsize))
+             for tex, fontsize in strings]
+    folder = tempfile.mkdtemp(prefix='tmp-', dir=TexManager.texcache)
+    try:
+        # Files are written to, and LaTeX runs in, texcache
+        texmanager.texcache = folder
+        try:
+            bodies = []
+            for tex, fontsize in strings:
+                with open(texmanager.make_tex(tex, fontsize), 'rb') as f:
+                    document = f.read()
+                start = document.index(r'\begin{document}') + len(r'\begin{document}')
+                bodies.append(document[start:document.rindex(r'\end{document}')])
+            # Only the body differs between the documents of the strings
+            with open(os.path.join(folder, 'batch.tex'), 'wb') as f:
+                f.write(document[:start])
+                for body in bodies:
+                    f.write('\\begingroup%s\\par\\endgroup\n\\newpage\n' % body)
+                f.write('\\end{document}\n')
+
+            batch = '\n'.join(tex for tex, fontsize in strings)
+            texmanager._run_checked_subprocess(
+                ['latex', '-interaction=nonstopmode', '--halt-on-error',
+                 'batch.tex'], batch)
+            with open(os.path.join(folder, 'batch.dvi'), 'rb') as f:
+                pages = _split_dvi(f.read())
+            if [count for count, page in pages] != range(1, len(strings) + 1):
+                raise ValueError('LaTeX made %d pages for %d strings'
+                                 % (len(pages), len(strings)))
+
+            pages_by_string = dict((pair, i + 1) for i, pair in enumerate(strings))
+            for name, (count, page) in zip(names, pages):
+                dvifile = os.path.join(TexManager.texcache, name + '.dvi')
+                if not os.path.exists(dvifile):
+                    tmp = os.path.join(folder, 'page.dvi')
+                    with open(tmp, 'wb') as f:
+                        f.write(page)
+                    os.rename(tmp, dvifile)
+
+            for dpi, pairs in dpis.items():
+                numbers = [pages_by_string[pair] for pair in pairs]
+                texmanager._run_checked_subprocess(
+                    ['dvipng', '-bg', 'Transparent', '-D', str(dpi), '-T', 'tight',
+                     '-pp', ','.join(map(str, numbers)),
+                     '-o', 'page-%d.png', 'batch.dvi'], batch)
+                for (tex, fontsize), number in zip(pairs, numbers):
+                    png = os.path.join(folder, 'page-%d.png' % number)
+                    # Left for dvipng on its own while drawing if missing
+                    if os.path.exists(png):
+                        name = os.path.basename(texmanager.get_basefile(tex, fontsize, dpi))
+                        os.rename(png, os.path.join(TexManager.texcache, name + '.png'))
+        finally:
+            del texmanager.texcache
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def run_latex_batches(jobs):
+    """
+    Fill the cache for the (string, fontsize, dpi) in 'jobs', as returned
+    by record_latex(), with dpi None for only the DVI file. LaTeX runs
+    once for up to LATEX_BATCH_SIZE strings, and dvipng once for those
+    of each dpi. A batch LaTeX can't process is left to the usual run
+    for each string when it is drawn.
+    Returns the number of strings LaTeX ran for.
+    """
+    if _folder is not None:
+        _settings_folder()
+    texmanager = TexManager()
+    if rcParams['text.latex.preview']:
+        # Baselines are read from LaTeX output of the whole document
+        missing = 0
+        for tex, fontsize, dpi in jobs:
+            if dpi is None:
+                done = os.path.exists('%s.dvi' % texmanager.get_basefile(tex, fontsize))
+                texmanager.make_dvi(tex, fontsize)
+            else:
+                done = os.path.exists('%s.png' % texmanager.get_basefile(tex, fontsize, dpi))
+                texmanager.make_png(tex, fontsize, dpi)
+            if not done:
+                missing += 1
+        return missing
+
+    missing = []
+    found = set()
+    dpis = {}
+    for tex, fontsize, dpi in sorted(set(jobs)):
+        needed = False
+        if dpi is not None and not os.path.exists(
+                '%s.png' % texmanager.get_basefile(tex, fontsize, dpi)):
+            dpis.setdefault(dpi, set()).add((tex, fontsize))
+            needed = True
+        if not os.path.exists('%s.dvi' % texmanager.get_basefile(tex, fontsize)):
+            needed = True
+        if needed and (tex, fontsize) not in found:
+            found.add((tex, fontsize))
+            missing.append((tex, fontsize))
+
+    runs = 0
+    for i in xrange(0, len(missing), LATEX_BATCH_SIZE):
+        strings = missing[i:i + LATEX_BATCH_SIZE]
+        batch_dpis = {}
+        for dpi, pairs in dpis.items():
+            pairs = [pair for pair in strings if pair in pairs]
+            if pairs:
+                batch_dpis[dpi] = pairs
+        try:
+            _run_batch(texmanager, strings, batch_dpis)
+            runs += len(strings)
+        except (RuntimeError, OSError, ValueError) as e:
+            print 'Warning: LaTeX could not run for a batch of %d strings, which are run one by one:' % len(strings)
+            print e
+    return runs
+
+
+def _format_path():
+    """
+    Returns the path (without .fmt) of the format of the current
+    preamble, for the installed LaTeX.
+    """
+    global _latex_version
+    if _latex_version is None:
+        try:
+            _latex_version = subprocess.check_output(['latex', '--version']).splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            _latex_version = ''
+
+    m = hashlib.sha1()
+    m.update(repr((_settings_key(), _latex_version)))
+    return os.path.join(TexManager.texcache, 'preamble-%s' % m.hexdigest()[:16])
+
+
+def _build_format(path):
+    """
+    Dump the preamble TexManager writes to a format file at path.
+    The \\documentclass of documents using it is ignored, and
+    packages loaded again are skipped by LaTeX.
+    """
+    folder = tempfile.mkdtemp(prefix='tmp-', dir=TexManager.texcache)
+    try:
+        # Files are written to, and LaTeX runs in, texcache
+        texmanager = TexManager()
+        texmanager.texcache = folder
+
+        with open(texmanager.make_tex('', 10)) as f:
+            tex = f.read()
+        preamble = tex[:tex.index(r'\begin{document}')]
+
+        with open(os.path.join(folder, 'preamble.tex'), 'w') as f:
+            f.write(preamble)
+            f.write('\\renewcommand{\\documentclass}[2][]{}\n')
+            f.write('\\dump\n')
+
+        _run_checked_subprocess(
+            texmanager, ['latex', '-ini', '-jobname=preamble', '&latex',
+                         'preamble.tex'], preamble)
+        os.rename(os.path.join(folder, 'preamble.fmt'), path + '.fmt')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def _get_format():
+    """
+    Returns the path of the format of the current preamble,
+    which is built if needed, or None if it can't be built.
+    """
+    path = _format_path()
+    if path not in _formats:
+        if not os.path.exists(path + '.fmt'):
+            try:
+                _build_format(path)
+            except (RuntimeError, OSError) as e:
+                print 'Warning: LaTeX format of the preamble could not be built, so it is not used:'
+                print e
+                _formats[path] = None
+                return None
+        _formats[path] = path
+    return _formats[path]
+
+
+def _run_with_format(self, command, tex):
+    """
+    TexManager._run_checked_subprocess() which runs LaTeX with
+    the format of the preamble.
+    """
+    if command[0] == 'latex' and '-ini' not in command:
+        path = _get_format()
+        if path is not None:
+            command = ['latex', '-fmt=' + path] + command[1:]
+    return _run_checked_subprocess(self, command, tex)
+
+
+def enable_latex_format():
+    """
+    Run LaTeX with a format file of the preamble (see
+    matplotlib_enable_latex), so packages are not loaded again for
+    each string. The format is built in the LaTeX cache folder when
+    it is first needed, and again if the preamble, font settings or
+    LaTeX version change.
+    Returns the path of the format for the current preamble, or None
+    if it can't be built, in which case LaTeX runs as usual.
+    """
+    TexManager._run_checked_subprocess = _run_with_format
+    return _get_format()
+
+
+def can_use_mathtext(s):
+    """
+    Returns True if s is a single formula, $...$, which matplotlib's
+    mathtext can render in place of LaTeX.
+    """
+    global _mathtext_parser
+    if s not in _mathtext_strings:
+        formula = s.strip()
+        result = (len(formula) > 2
+                  and formula.startswith('$') and formula.endswith('$')
+                  and formula.count('$') == 2
+                  and '\n' not in formula)
+        if result:
+            if _mathtext_parser is None:
+                _mathtext_parser = MathTextParser('path')
+            try:
+                _mathtext_parser.parse(formula)
+            except ValueError:
+                # Unknown to mathtext, like \\bm or matrices
+                result = False
+        _mathtext_strings[s] = result
+    return _mathtext_strings[s]
+
+
+def _get_usetex_or_mathtext(self):
+    """
+    Text.get_usetex() which is False for usetex text
+    that mathtext can render.
+    """
+    usetex = _get_usetex(self)
+    if usetex and can_use_mathtext(self.get_text()):
+        return False
+    return usetex
+
+
+def enable_mathtext_fast_path():
+    """
+    Render usetex text with matplotlib's mathtext instead of LaTeX,
+    when the text is a single formula which mathtext can render (see
+    can_use_mathtext). Other text, like latex_matrix() output or
+    formulas using \\bm, still uses LaTeX. Sets mathtext.fontset
+    to 'cm', which matches the math fonts of LaTeX.
+    """
+    global _mathtext_fast_path
+    _mathtext_fast_path = True
+    rcParams['mathtext.fontset'] = 'cm'
+    Text.get_usetex = _get_usetex_or_mathtext
+
+
+def mathtext_fast_path_enabled():
+    """
+    Returns True if enable_mathtext_fast_path() was called.
+    """
+    return _mathtext_fast_path